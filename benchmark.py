@@ -0,0 +1,433 @@
+"""
+Times buck_file_generator against synthetic Gradle projects, using a stub
+buck executable and a fake gradle cache so no network or real buck is
+needed. Each --scale multiplies the number of modules and libraries.
+Before timing anything, the class file parser is checked against the
+class files in fixtures/.
+
+    python benchmark.py --scale 1 --scale 10 --scale 100
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import stat
+import sys
+import tempfile
+import time
+import zipfile
+from os import path
+
+import buck_file_generator
+
+FIXTURES_DIR = path.join(path.dirname(path.abspath(__file__)), 'fixtures')
+CLASS_FILE_FIXTURES = {
+    'Widget.class': (
+        'com.example',
+        'Widget.java',
+        {'com.example.Widget',
+         'com.example.base.View',
+         'com.example.internal.Cache',
+         'com.example.internal.Helper',
+         'com.example.model.Item',
+         'com.example.model.Tag',
+         'java.io.Serializable',
+         'java.util.List'},
+        {'com.example.base.View',
+         'com.example.model.Item',
+         'java.io.Serializable',
+         'java.util.List'},
+    ),
+}
+
+STUB_BUCK = r"""#!{python}
+import json
+import sys
+
+with open({spec!r}, 'r') as spec_file:
+    spec = json.load(spec_file)
+buck_args = sys.argv[1:]
+if buck_args[0] == 'targets':
+    if '--show_output' in buck_args:
+        for target in buck_args[buck_args.index('--show_output') + 1:]:
+            print target + ' ' + spec['outputs'][target]
+    elif '--type' in buck_args:
+        types = buck_args[buck_args.index('--type') + 1:]
+        rules = [x for x in spec['rules'] if x['buck.type'] in types]
+        if '--json' in buck_args:
+            print json.dumps(rules)
+        else:
+            for rule in rules:
+                print '//{{0}}:{{1}}'.format(rule['buck.base_path'],
+                                             rule['name'])
+"""
+
+GRADLE_FILE_TEMPLATE = """repositories {{
+    jcenter()
+}}
+
+dependencies {{
+{dependencies}
+}}
+"""
+
+JAVA_FILE_TEMPLATE = """package {package};
+
+{imports}
+
+public class {name} {{
+}}
+"""
+
+
+def get_library_coordinate(library):
+    return 'com.bench.lib{0}'.format(library), 'lib{0}'.format(library), '1.0'
+
+
+def get_library_classes(library, classes_per_library):
+    group = get_library_coordinate(library)[0]
+    return ['{0}.Lib{1}Class{2}'.format(group, library, x)
+            for x in xrange(classes_per_library)]
+
+
+def create_classes_jar(jar_path, classes):
+    with zipfile.ZipFile(jar_path, 'w') as jar_file:
+        for java_class in classes:
+            jar_file.writestr(java_class.replace('.', '/') + '.class', '')
+
+
+def generate_gradle_cache(gradle_cache, libraries, classes_per_library):
+    """
+    Lays out modules-2/files-2.1 the way gradle does, with every third
+    library packaged as an aar. Returns the stub buck rules and outputs
+    for the matching prebuilt targets.
+    """
+    rules = []
+    outputs = {}
+    for library in xrange(libraries):
+        group, dep_id, version = get_library_coordinate(library)
+        dep_type = 'aar' if library % 3 == 0 else 'jar'
+        artifact_dir = path.join(gradle_cache,
+                                 buck_file_generator.GRADLE_CACHE_FILES,
+                                 group,
+                                 dep_id,
+                                 version,
+                                 '{0:040x}'.format(library + 1))
+        os.makedirs(artifact_dir)
+        artifact = path.join(artifact_dir,
+                             '{0}-{1}.{2}'.format(dep_id, version, dep_type))
+        classes = get_library_classes(library, classes_per_library)
+        if dep_type == 'aar':
+            classes_jar = path.join(artifact_dir, 'classes.jar')
+            create_classes_jar(classes_jar, classes)
+            with zipfile.ZipFile(artifact, 'w') as aar_file:
+                aar_file.write(classes_jar, 'classes.jar')
+            os.remove(classes_jar)
+        else:
+            create_classes_jar(artifact, classes)
+        rules.append({
+            'buck.type': ('android_prebuilt_aar' if dep_type == 'aar' else
+                          'prebuilt_jar'),
+            'buck.base_path': 'libs',
+            'name': dep_id,
+        })
+        outputs['//libs:' + dep_id] = artifact
+    return rules, outputs
+
+
+def generate_project(project_dir, options, modules, libraries):
+    """
+    Writes modules that each have a build.gradle and packages of java files
+    importing classes from their own or earlier modules and from libraries.
+    """
+    rng = random.Random(options.seed)
+    all_classes = []
+    for module in xrange(modules):
+        module_dir = path.join(project_dir, 'module{0}'.format(module))
+        module_libraries = rng.sample(xrange(libraries),
+                                      min(libraries, options.libraries_used))
+        os.makedirs(module_dir)
+        with open(path.join(module_dir, 'build.gradle'), 'w') as gradle_file:
+            gradle_file.write(GRADLE_FILE_TEMPLATE.format(
+                dependencies='\n'.join(
+                    "    compile '{0}:{1}:{2}'".format(
+                        *get_library_coordinate(x))
+                    for x in sorted(module_libraries))))
+
+        third_party_classes = []
+        for library in module_libraries:
+            third_party_classes.extend(
+                get_library_classes(library, options.classes_per_library))
+        module_classes = []
+        for package_number in xrange(options.packages):
+            package = 'com.bench.m{0}.p{1}'.format(module, package_number)
+            package_dir = path.join(module_dir, 'src', 'main', 'java',
+                                    *package.split('.'))
+            os.makedirs(package_dir)
+            for file_number in xrange(options.files):
+                name = 'C{0}'.format(file_number)
+                importable = all_classes + module_classes + third_party_classes
+                imports = rng.sample(importable,
+                                     min(len(importable), options.imports))
+                with open(path.join(package_dir, name + '.java'),
+                          'w') as java_file:
+                    java_file.write(JAVA_FILE_TEMPLATE.format(
+                        package=package,
+                        imports='\n'.join('import {0};'.format(x)
+                                          for x in sorted(imports)),
+                        name=name))
+                module_classes.append(package + '.' + name)
+        all_classes.extend(module_classes)
+
+
+def write_stub_buck(project_dir, rules, outputs):
+    spec = path.join(project_dir, 'stub_buck.json')
+    with open(spec, 'w') as spec_file:
+        json.dump({'rules': rules, 'outputs': outputs}, spec_file)
+    stub_buck = path.join(project_dir, 'stub_buck')
+    with open(stub_buck, 'w') as stub_buck_file:
+        stub_buck_file.write(STUB_BUCK.format(python=sys.executable,
+                                              spec=spec))
+    os.chmod(stub_buck, os.stat(stub_buck).st_mode | stat.S_IEXEC)
+    return stub_buck
+
+
+def check_class_file_fixtures():
+    """
+    Parses each class file fixture and compares it with what it is known
+    to hold: a private field and method that stay out of its ABI, a
+    generic signature, an array class and a string that looks like a
+    descriptor.
+    """
+    for name, expected in sorted(CLASS_FILE_FIXTURES.iteritems()):
+        with open(path.join(FIXTURES_DIR, name), 'rb') as class_file:
+            parsed_class = buck_file_generator.parse_class_file(
+                class_file.read())
+        if parsed_class != expected:
+            raise Exception('Parsed {0} as {1}, expected {2}'.format(
+                name, parsed_class, expected))
+
+
+def time_call(timings, name, fn, *fn_args):
+    start = time.time()
+    result = fn(*fn_args)
+    timings[name] = time.time() - start
+    print '\t{0}: {1:.3f}s'.format(name, timings[name])
+    return result
+
+
+def run_benchmark(work_dir, options, scale):
+    modules = options.modules * scale
+    libraries = options.libraries * scale
+    print '**** Scale {0}x: {1} modules, {2} libraries ***'.format(
+        scale, modules, libraries)
+    project_dir = path.join(work_dir, 'scale{0}'.format(scale))
+    gradle_cache = path.join(work_dir, 'gradle_cache{0}'.format(scale))
+    cache_dir = path.join(project_dir, '.gradle_to_buck')
+    rules, outputs = generate_gradle_cache(gradle_cache,
+                                           libraries,
+                                           options.classes_per_library)
+    generate_project(project_dir, options, modules, libraries)
+    stub_buck = write_stub_buck(project_dir, rules, outputs)
+
+    timings = {}
+    current_dir = os.getcwd()
+    os.chdir(project_dir)
+    try:
+        buck_file_generator.configure_buck_session(stub_buck)
+        os.mkdir('.buckd')
+        gradle_files = sorted(
+            path.join(root, 'build.gradle')
+            for root, dirs, files in os.walk('.')
+            if 'build.gradle' in files)
+        src_roots = ['/' + path.relpath(path.join(path.dirname(x),
+                                                  'src', 'main', 'java'))
+                     for x in gradle_files]
+        with open('.buckconfig', 'w') as buckconfig:
+            buckconfig.write(buck_file_generator.BUCK_CONFIG_TEMPLATE.format(
+                src_roots=','.join(src_roots),
+                maven_repositories=''))
+
+        gradle_build_files = time_call(
+            timings, 'parse_gradle_files',
+            buck_file_generator.parse_gradle_files, gradle_files)
+        maven_coordinates = time_call(
+            timings, 'get_maven_coordinates (cold)',
+            buck_file_generator.get_maven_coordinates,
+            gradle_build_files, gradle_cache, cache_dir)
+        time_call(timings, 'get_maven_coordinates (warm)',
+                  buck_file_generator.get_maven_coordinates,
+                  gradle_build_files, gradle_cache, cache_dir)
+        os.mkdir('libs')
+        with open(path.join('libs', 'BUCK'), 'w') as buck_file:
+            for maven_coordinate in maven_coordinates.values():
+                buck_file.write(buck_file_generator.REMOTE_DEP_TEMPLATE.format(
+                    **maven_coordinate))
+
+        third_party_map, android_libraries = time_call(
+            timings, 'create_third_party_map (cold)',
+            buck_file_generator.create_third_party_map, cache_dir)
+        time_call(timings, 'create_third_party_map (warm)',
+                  buck_file_generator.create_third_party_map, cache_dir)
+        shutil.rmtree(cache_dir)
+        time_call(timings, 'create_third_party_map_batched (cold)',
+                  buck_file_generator.create_third_party_map_batched,
+                  cache_dir)
+        time_call(timings, 'create_third_party_map_batched (warm)',
+                  buck_file_generator.create_third_party_map_batched,
+                  cache_dir)
+
+        class_indexes = time_call(
+            timings, 'create class indexes',
+            buck_file_generator.create_class_indexes,
+            '.buckconfig', src_roots, third_party_map)
+        packages = buck_file_generator.get_java_packages('.buckconfig',
+                                                         src_roots)
+
+        def get_deps_for_all_packages():
+            for root, files in packages:
+                buck_file_generator.get_deps_for_files(root,
+                                                       files,
+                                                       '//' + root,
+                                                       class_indexes,
+                                                       set())
+
+        buck_file_generator.JAVA_SOURCES.clear()
+        time_call(timings, 'get_deps_for_files (cold)',
+                  get_deps_for_all_packages)
+        time_call(timings, 'get_deps_for_files (warm)',
+                  get_deps_for_all_packages)
+
+        buck_file_generator.JAVA_SOURCES.clear()
+        buck_rules = time_call(
+            timings, 'generate_default_buck_files',
+            buck_file_generator.generate_default_buck_files,
+            '.buckconfig', src_roots, third_party_map,
+            set(android_libraries), 'java_library', options.jobs)
+    finally:
+        os.chdir(current_dir)
+
+    return {
+        'scale': scale,
+        'modules': modules,
+        'libraries': libraries,
+        'java_files': modules * options.packages * options.files,
+        'rules': len(buck_rules),
+        'timings': timings,
+    }
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description='Benchmark buck_file_generator on synthetic projects.')
+    parser.add_argument(
+        '--scale',
+        dest='scales',
+        help='Multiplier for the number of modules and libraries. May be '
+             'given more than once.',
+        type=int,
+        action='append',
+    )
+    parser.add_argument(
+        '--modules',
+        dest='modules',
+        help='Number of gradle modules at scale 1.',
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        '--packages',
+        dest='packages',
+        help='Number of java packages per module.',
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        '--files',
+        dest='files',
+        help='Number of java files per package.',
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        '--imports',
+        dest='imports',
+        help='Number of imports per java file.',
+        type=int,
+        default=8,
+    )
+    parser.add_argument(
+        '--libraries',
+        dest='libraries',
+        help='Number of third party libraries at scale 1.',
+        type=int,
+        default=10,
+    )
+    parser.add_argument(
+        '--libraries_used',
+        dest='libraries_used',
+        help='Number of libraries each module depends on.',
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        '--classes_per_library',
+        dest='classes_per_library',
+        help='Number of classes in each library.',
+        type=int,
+        default=50,
+    )
+    parser.add_argument(
+        '--jobs',
+        dest='jobs',
+        help='Number of processes used by generate_default_buck_files.',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '--seed',
+        dest='seed',
+        help='Random seed, so runs generate the same projects.',
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        '--output',
+        dest='output',
+        help='Write the results as json to this path.',
+        default=None,
+    )
+    parser.add_argument(
+        '--keep',
+        dest='keep',
+        help='Keep the generated projects instead of deleting them.',
+        action='store_true',
+        default=False
+    )
+    return parser
+
+
+def main():
+    options = create_parser().parse_args()
+    buck_file_generator.args = buck_file_generator.create_parser().parse_args(
+        ['--jobs', str(options.jobs)])
+    check_class_file_fixtures()
+    work_dir = tempfile.mkdtemp(prefix='gradle_to_buck_benchmark')
+    results = []
+    try:
+        for scale in options.scales or [1]:
+            results.append(run_benchmark(work_dir, options, scale))
+    finally:
+        if options.keep:
+            print 'Generated projects are in {0}'.format(work_dir)
+        else:
+            shutil.rmtree(work_dir)
+
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
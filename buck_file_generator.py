@@ -1,11 +1,23 @@
 import argparse
+import cProfile
+import collections
+import contextlib
+import difflib
+import hashlib
+import io
+import json
+import multiprocessing
 import os
 import re
-import shutil
+import sqlite3
+import struct
 import subprocess
 import tempfile
+import threading
+import time
 import xml.etree.cElementTree as xml
 import zipfile
+from multiprocessing.pool import ThreadPool
 from os import path
 
 SRC_ROOTS_REGEX = re.compile(r'^\s*src_roots\s*=\s*(.*)$')
@@ -15,13 +27,18 @@ BUCK_FILE_TEMPLATE = """{library_type}(
   deps = [
 {deps}
   ],
-  visibility = [
+{exported_deps}  visibility = [
     'PUBLIC',
   ],
 )
 
 """
 
+EXPORTED_DEPS_TEMPLATE = """  exported_deps = [
+{0}
+  ],
+"""
+
 ANDROID_RESOURCE_TEMPLATE = """android_resource(
   name = 'res',
   package = '{package}',
@@ -68,28 +85,116 @@ INTERFACE_FILES_TEMPLATE = """INTERFACE_FILES = [
 
 """
 
-CYCLE_PREFIX = 'BUILD FAILED: Cycle found: '
+FAILED_RULE = re.compile(r'(//\S*:[^\s:]+?)[:.]?\s+(?:has\s+)?failed')
 
-THIRD_PARTY_JAR = re.compile(r"^\s*(?:\S*ompile|provided)\s*'(\S*)'$")
 MAVEN_COORDINATE = re.compile(r"([^:]+):([^:]+):([^:]+:)?([^:]+)")
 
-CLASS_FILE = re.compile(r'\s(\S+).class$')
+CLASS_FILE = re.compile(r'^(\S+)\.class$')
 JAVA_IMPORT = re.compile(r'import (.*);$')
 
 NAME_DECLARATION = re.compile(r"\s*name\s=\s'(\S*)'.*")
 DEP_DECLARATION = re.compile(r"\s*'(\S*)',")
+STRING_ATTRIBUTE = re.compile(r"\s*(\w+)\s*=\s*'([^']*)',?$")
 DEPS_START = re.compile(r'\s*deps\s*=\s*\[$')
+EXPORTED_DEPS_START = re.compile(r'\s*exported_deps\s*=\s*\[$')
+RULE_START = re.compile(r'^(\w+)\($')
 
 PACKAGE_DECLARATION = re.compile(r"\s*package\s=\s'(\S*)'.*")
-FNULL = open(os.devnull, 'w')
 
 INTERFACE_DECLARATION = re.compile(r'public\s+@?interface\s+.*')
+JAVA_PACKAGE = re.compile(r'^\s*package\s+([\w.]+)\s*;')
+TYPE_DECLARATION = re.compile(
+    r'^\s*(?:[a-z]+\s+)*(?:class|@?interface|enum)\s+(\w+)')
+
+JavaSource = collections.namedtuple(
+    'JavaSource', ['package', 'imports', 'is_interface', 'declared_types'])
+JAVA_SOURCES = {}
+JAVA_COMMENT_OR_STRING = re.compile(
+    r'//[^\n]*|/\*.*?\*/|"(?:[^"\\\n]|\\.)*"|\'(?:[^\'\\\n]|\\.)*\'',
+    re.DOTALL)
+JAVA_CLASS_REFERENCE = re.compile(r'\b[A-Z][\w$]*')
+JAVA_IMPORT_STATEMENT = re.compile(r'^\s*(?:import|package)\s[^;]*;',
+                                   re.MULTILINE)
+JAVA_PUBLIC_DECLARATION = re.compile(r'\b(?:public|protected)\s([^;{=]*)')
+JavaReferences = collections.namedtuple(
+    'JavaReferences', ['references', 'exported_references'])
+JAVA_REFERENCES = {}
+
+CLASS_FILE_MAGIC = 0xCAFEBABE
+CLASS_DESCRIPTOR_REFERENCE = re.compile(r'L([^;<]+)[;<]')
+CONSTANT_POOL_SIZES = {3: 4, 4: 4, 5: 8, 6: 8, 7: 2, 8: 2, 9: 4, 10: 4, 11: 4,
+                       12: 4, 15: 3, 16: 2, 17: 4, 18: 4, 19: 2, 20: 2}
+ACC_PUBLIC = 0x0001
+ACC_PROTECTED = 0x0004
+CLASS_OUTPUT_DIRS = [path.join('build', 'intermediates'),
+                     path.join('build', 'classes')]
+BytecodeReferences = collections.namedtuple(
+    'BytecodeReferences', ['mtime', 'references', 'exported_references'])
+
+ClassIndex = collections.namedtuple('ClassIndex', ['packages'])
+CLASS_NAME_START = re.compile(r'(?:^|\.)(?=[A-Z])')
+PackageRule = collections.namedtuple(
+    'PackageRule',
+    ['target',
+     'name',
+     'sources',
+     'deps',
+     'has_android_deps',
+     'imports',
+     'exported_deps',
+     'exported_imports'])
+PACKAGE_ANALYSIS = {}
+
+BuckPlan = collections.namedtuple('BuckPlan', ['files', 'rules'])
+BUCK_FILES = {}
+BUCK_SESSION = {
+    'executable': 'buck',
+    'semaphore': threading.BoundedSemaphore(1),
+    'warm_up_lock': threading.Lock(),
+    'warm': False,
+    'calls': [],
+}
+CACHE_SESSION = {
+    'read_only': False,
+}
+PROFILE = {
+    'enabled': False,
+    'start': None,
+    'phase': None,
+    'phases': [],
+    'steps': {},
+    'counters': collections.Counter(),
+}
 
 POSSIBLE_MAVEN_TYPES = [('aar', 'android_prebuilt_aar', 'aar'),
                         ('jar', 'prebuilt_jar', 'binary_jar')]
 
 INTERFACE_SUFFIX = '-interfaces'
 
+GRADLE_CACHE_FILES = path.join('modules-2', 'files-2.1')
+GRADLE_CACHE_INDEX = 'gradle_cache_index.json'
+GRADLE_CACHE_INDEX_DEPTH = 3
+
+CLASS_INDEX = 'class_index.sqlite'
+CLASS_INDEX_VERSION = 2
+ARTIFACT_INDEX_ENTRY = '{0}.json'
+M2REPOSITORY_INDEX = 'm2repository_index.json'
+
+POM_PROPERTY = re.compile(r'\$\{([\w.-]+)\}')
+POM_SCOPES = ['compile', 'runtime']
+POM_FILES = {}
+
+INCREMENTAL_STATE = 'incremental_state.json'
+
+PACKAGE_CLASS_SUFFIXES = {
+    'android_build_config': '.BuildConfig',
+    'android_resource': '.R',
+}
+THIRD_PARTY_RULE_TYPES = ['prebuilt_jar',
+                          'android_prebuilt_aar',
+                          'android_build_config',
+                          'android_resource']
+
 BUCK_CONFIG_TEMPLATE = r"""[java]
     ; Indicates that any folder named src or test
     ; are folders that contain Java code.
@@ -99,6 +204,7 @@ BUCK_CONFIG_TEMPLATE = r"""[java]
     .git, \
     .buckd, \
     .gradle, \
+    .gradle_to_buck, \
     build, \
     proguard
   temp_files = \
@@ -117,34 +223,232 @@ BUCK_CONFIG_TEMPLATE = r"""[java]
   {maven_repositories}
 """
 
-REPOSITORY_START = re.compile(r'repositories \{')
-GRADLE_EXTERNAL_REPO = re.compile(
-    'maven\\s+\\{\\s+url\\s+["\'](.*)["\']\\s+\\}')
+GRADLE_TOKEN = re.compile(r"""
+    (//[^\n]*|/\*.*?\*/)
+    |('(?:[^'\\\n]|\\.)*'|"(?:[^"\\\n]|\\.)*")
+    |([\w.$]+)
+    |(\S)
+""", re.VERBOSE | re.DOTALL)
+GRADLE_VARIABLE = re.compile(r'\$\{\s*([\w.]+)\s*\}|\$([\w.]+)')
+GRADLE_VARIABLE_PREFIXES = ['rootProject.ext.',
+                            'project.ext.',
+                            'ext.',
+                            'rootProject.',
+                            'project.']
+GRADLE_PROPERTY = re.compile(r'^\s*([^#!=:\s]+)\s*[=:\s]\s*(.*?)\s*$')
+DEPENDENCY_CONFIGURATION = re.compile(
+    r'^(?:\w*[cC]ompile(?:Only)?|provided|\w*[iI]mplementation|\w*[aA]pi)$')
 REPOSITORY_MAP = {
     'jcenter': 'https://jcenter.bintray.com',
     'mavenCentral': 'https://repo1.maven.org/maven2',
+    'google': 'https://maven.google.com',
 }
 
-
-def get_repositories_from_gradle_file(gradle_file_path):
-    in_repositories = False
-    result = set()
+GradleBuildFile = collections.namedtuple(
+    'GradleBuildFile', ['repositories', 'dependencies', 'variables'])
+
+
+def tokenize_gradle_file(contents):
+    tokens = []
+    for match in GRADLE_TOKEN.finditer(contents):
+        comment, string, word, symbol = match.groups()
+        if string:
+            tokens.append(('string', string[1:-1]))
+        elif word:
+            tokens.append(('word', word))
+        elif symbol:
+            tokens.append(('symbol', symbol))
+    return tokens
+
+
+def get_gradle_variable_name(name):
+    for prefix in GRADLE_VARIABLE_PREFIXES:
+        if name.startswith(prefix):
+            return name[len(prefix):]
+    return name
+
+
+def parse_gradle_value(tokens, i, variables, name):
+    """
+    Reads the value assigned to a variable at tokens[i], which is either a
+    string or a map of strings such as ext.versions = [support: '25.0.0'],
+    whose entries become 'versions.support'. Returns the next index.
+    """
+    kind, value = tokens[i]
+    if kind == 'string':
+        variables[name] = value
+        return i + 1
+    if (kind, value) != ('symbol', '['):
+        return i
+    i += 1
+    while (i + 2 < len(tokens) and
+           tokens[i + 1] == ('symbol', ':') and
+           tokens[i + 2][0] == 'string'):
+        variables['{0}.{1}'.format(name, tokens[i][1])] = tokens[i + 2][1]
+        i += 3
+        if tokens[i:i + 1] == [('symbol', ',')]:
+            i += 1
+    return i
+
+
+def parse_gradle_dependency(tokens, i, dependencies):
+    """
+    Reads the notations following a dependency configuration at tokens[i]:
+    strings, variables and group:/name:/version: maps, with or without
+    parentheses. project(), files() and the like are skipped. Returns the
+    next index.
+    """
+    if tokens[i:i + 1] == [('symbol', '(')]:
+        i += 1
+    while i < len(tokens):
+        kind, value = tokens[i]
+        if i + 1 < len(tokens) and tokens[i + 1] == ('symbol', '('):
+            return i
+        elif (kind == 'word' and
+                tokens[i + 1:i + 2] == [('symbol', ':')]):
+            notation = {}
+            while (i + 2 < len(tokens) and
+                   tokens[i][0] == 'word' and
+                   tokens[i + 1] == ('symbol', ':')):
+                entry_kind, entry = tokens[i + 2]
+                if entry_kind == 'word':
+                    entry = '${' + entry + '}'
+                notation[tokens[i][1]] = entry
+                i += 3
+                if (tokens[i:i + 1] == [('symbol', ',')] and
+                        tokens[i + 2:i + 3] == [('symbol', ':')]):
+                    i += 1
+            if {'group', 'name', 'version'}.issubset(notation):
+                dependency = '{group}:{name}:{version}'.format(**notation)
+                if 'ext' in notation:
+                    dependency += '@' + notation['ext']
+                dependencies.append(dependency)
+        elif kind == 'string':
+            dependencies.append(value)
+            i += 1
+        elif kind == 'word' and not DEPENDENCY_CONFIGURATION.match(value):
+            dependencies.append('${' + value + '}')
+            i += 1
+        else:
+            return i
+        if tokens[i:i + 1] != [('symbol', ',')]:
+            return i
+        i += 1
+    return i
+
+
+def parse_gradle_file(gradle_file_path):
+    """
+    Reads a build.gradle once, returning the repositories and dependency
+    notations it declares, and the ext variables it defines. Variables in
+    them are left for resolve_gradle_variables, since the root project's
+    variables are only known once it has been parsed too.
+    """
     with open(gradle_file_path, 'r') as gradle_file:
-        for line in gradle_file.readlines():
-            repository_start_match = REPOSITORY_START.search(line)
-            if repository_start_match:
-                in_repositories = True
-            elif in_repositories:
-                if line.strip().startswith('}'):
-                    in_repositories = False
-                else:
-                    external_repo_match = GRADLE_EXTERNAL_REPO.search(line)
-                    repo_function_name = line.strip().strip('()')
-                    if external_repo_match:
-                        result.add(external_repo_match.group(1))
-                    elif repo_function_name in REPOSITORY_MAP:
-                        result.add(REPOSITORY_MAP[repo_function_name])
-    return result
+        tokens = tokenize_gradle_file(gradle_file.read())
+    repositories = []
+    dependencies = []
+    variables = {}
+    blocks = []
+    i = 0
+    while i < len(tokens):
+        kind, value = tokens[i]
+        block = blocks[-1] if blocks else None
+        next_token = tokens[i + 1] if i + 1 < len(tokens) else None
+        i += 1
+        if kind == 'symbol':
+            if value == '{':
+                previous_kind, previous_value = tokens[max(i - 2, 0)]
+                blocks.append(previous_value if previous_kind == 'word'
+                              else None)
+            elif value == '}' and blocks:
+                blocks.pop()
+        elif kind != 'word':
+            continue
+        elif block == 'repositories' and value in REPOSITORY_MAP:
+            repositories.append(REPOSITORY_MAP[value])
+        elif (block == 'maven' and
+                blocks[-2:-1] == ['repositories'] and
+                value == 'url'):
+            while i < len(tokens) and tokens[i][0] != 'string':
+                if tokens[i][1] not in ('=', 'uri', '('):
+                    break
+                i += 1
+            if i < len(tokens) and tokens[i][0] == 'string':
+                repositories.append(tokens[i][1])
+        elif (block == 'dependencies' and
+                'buildscript' not in blocks and
+                DEPENDENCY_CONFIGURATION.match(value)):
+            i = parse_gradle_dependency(tokens, i, dependencies)
+        elif next_token == ('symbol', '=') and i + 1 < len(tokens):
+            if block == 'ext':
+                i = parse_gradle_value(tokens, i + 1, variables, value)
+            elif '.ext.' in '.' + value:
+                i = parse_gradle_value(tokens,
+                                       i + 1,
+                                       variables,
+                                       get_gradle_variable_name(value))
+            elif tokens[i - 2:i - 1] == [('word', 'def')]:
+                i = parse_gradle_value(tokens, i + 1, variables, value)
+    return GradleBuildFile(repositories, dependencies, variables)
+
+
+def read_gradle_properties(directory):
+    properties = {}
+    properties_path = path.join(directory, 'gradle.properties')
+    if not path.exists(properties_path):
+        return properties
+    with open(properties_path, 'r') as properties_file:
+        for line in properties_file:
+            match = GRADLE_PROPERTY.match(line)
+            if match:
+                properties[match.group(1)] = match.group(2)
+    return properties
+
+
+def resolve_gradle_variables(value, variables):
+    for _ in xrange(10):
+        resolved_value = GRADLE_VARIABLE.sub(
+            lambda x: variables.get(
+                get_gradle_variable_name(x.group(1) or x.group(2)),
+                x.group(0)),
+            value)
+        if resolved_value == value:
+            break
+        value = resolved_value
+    return value
+
+
+def parse_gradle_files(gradle_files):
+    """
+    Parses every build.gradle, then resolves the variables used by their
+    repositories and dependencies. As in gradle, the ext variables of the
+    root project, in the current directory, and its gradle.properties are
+    visible from every build file.
+    """
+    parsed_files = []
+    for gradle_file in gradle_files:
+        with profile_step('parse_gradle_file'):
+            parsed_files.append((path.dirname(path.abspath(gradle_file)),
+                                 parse_gradle_file(gradle_file)))
+    root_variables = read_gradle_properties(os.getcwd())
+    for directory, build_file in parsed_files:
+        if directory == os.getcwd():
+            root_variables.update(build_file.variables)
+
+    gradle_build_files = []
+    for directory, build_file in parsed_files:
+        variables = dict(root_variables)
+        if directory != os.getcwd():
+            variables.update(read_gradle_properties(directory))
+        variables.update(build_file.variables)
+        gradle_build_files.append(GradleBuildFile(
+            [resolve_gradle_variables(x, variables)
+             for x in build_file.repositories],
+            [resolve_gradle_variables(x, variables)
+             for x in build_file.dependencies],
+            variables))
+    return gradle_build_files
 
 
 def get_source_roots(buckconfig):
@@ -158,18 +462,197 @@ def get_source_roots(buckconfig):
     return src_roots
 
 
+def get_profile_times():
+    times = os.times()
+    return time.time(), times[0] + times[1], times[2] + times[3]
+
+
+def get_profile_timing(start):
+    wall, cpu, child_cpu = get_profile_times()
+    return {
+        'wall': wall - start[0],
+        'cpu': cpu - start[1],
+        'child_cpu': child_cpu - start[2],
+    }
+
+
+def count_calls(name, fn):
+    def counted(*fn_args, **fn_kwargs):
+        PROFILE['counters'][name] += 1
+        return fn(*fn_args, **fn_kwargs)
+    return counted
+
+
+def enable_profiling():
+    """
+    Starts recording phase and step timings, and counts filesystem calls by
+    wrapping os.stat, os.lstat and os.listdir, which path.exists, os.walk
+    and friends go through. Work done in --jobs worker processes is not
+    counted.
+    """
+    PROFILE['enabled'] = True
+    PROFILE['start'] = get_profile_times()
+    os.stat = count_calls('stat', os.stat)
+    os.lstat = count_calls('lstat', os.lstat)
+    os.listdir = count_calls('listdir', os.listdir)
+
+
+def count_profile_event(name, count=1):
+    if PROFILE['enabled']:
+        PROFILE['counters'][name] += count
+
+
+@contextlib.contextmanager
+def profile_step(name):
+    """
+    Adds the wall and cpu time spent in the block to the totals for name.
+    child_cpu is the cpu used by subprocesses that finished in the block.
+    """
+    if not PROFILE['enabled']:
+        yield
+        return
+    start = get_profile_times()
+    try:
+        yield
+    finally:
+        timing = get_profile_timing(start)
+        step = PROFILE['steps'].setdefault(name, {
+            'count': 0,
+            'wall': 0.0,
+            'cpu': 0.0,
+            'child_cpu': 0.0,
+        })
+        step['count'] += 1
+        for key, value in timing.iteritems():
+            step[key] += value
+
+
+def end_phase():
+    if PROFILE['phase']:
+        name, start = PROFILE['phase']
+        PROFILE['phases'].append(dict(get_profile_timing(start), name=name))
+        PROFILE['phase'] = None
+
+
+def begin_phase(name):
+    end_phase()
+    print "**** {0} ***".format(name)
+    if PROFILE['enabled']:
+        PROFILE['phase'] = (name, get_profile_times())
+
+
+def write_profile_report(report_path):
+    end_phase()
+    report = {
+        'total': get_profile_timing(PROFILE['start']),
+        'phases': PROFILE['phases'],
+        'steps': PROFILE['steps'],
+        'counters': PROFILE['counters'],
+    }
+    write_file_atomically(report_path,
+                          json.dumps(report, indent=2, sort_keys=True))
+
+
+def create_buck_plan():
+    return BuckPlan(collections.OrderedDict(), collections.OrderedDict())
+
+
+def write_file_atomically(file_path, contents):
+    directory = path.dirname(file_path) or '.'
+    if not path.exists(directory):
+        os.makedirs(directory)
+    handle, temp_path = tempfile.mkstemp(dir=directory,
+                                         prefix=path.basename(file_path))
+    with os.fdopen(handle, 'w') as temp_file:
+        temp_file.write(contents)
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(temp_path, 0o666 & ~umask)
+    os.rename(temp_path, file_path)
+
+
+def write_buck_plan(plan):
+    for file_path, contents in plan.files.iteritems():
+        write_file_atomically(file_path, contents)
+    plan.files.clear()
+
+
+def print_buck_plan(plan, plan_format):
+    if plan_format == 'json':
+        print json.dumps({'files': plan.files.keys(), 'rules': plan.rules},
+                         indent=2,
+                         sort_keys=True)
+        return
+    for file_path, contents in plan.files.iteritems():
+        existing_lines = []
+        if path.exists(file_path):
+            with open(file_path, 'r') as existing_file:
+                existing_lines = existing_file.readlines()
+        for line in difflib.unified_diff(existing_lines,
+                                         contents.splitlines(True),
+                                         fromfile=path.join('a', file_path),
+                                         tofile=path.join('b', file_path)):
+            print line,
+
+
 def format_deps_for_buck_file(deps):
     return sorted(("     '{0}',".format(dep) for dep in deps))
 
 
+def parse_java_source(java_file_path):
+    """
+    Reads a java file up to its first type declaration, which is as far as
+    the package, imports and interface check need to look.
+    """
+    package = None
+    imports = []
+    is_interface = False
+    declared_types = []
+    in_comment = False
+    with open(java_file_path, 'r') as java_file:
+        for line in java_file:
+            stripped_line = line.strip()
+            if in_comment:
+                in_comment = '*/' not in stripped_line
+                continue
+            if stripped_line.startswith('/*'):
+                in_comment = '*/' not in stripped_line
+                continue
+            if not stripped_line or stripped_line.startswith('//'):
+                continue
+            import_match = JAVA_IMPORT.match(line)
+            if import_match:
+                imports.append(import_match.group(1))
+                continue
+            package_match = JAVA_PACKAGE.match(line)
+            if package_match:
+                package = package_match.group(1)
+                continue
+            type_match = TYPE_DECLARATION.match(line)
+            if type_match:
+                declared_types.append(type_match.group(1))
+                is_interface = bool(INTERFACE_DECLARATION.match(line))
+                break
+    return JavaSource(package, imports, is_interface, declared_types)
+
+
+def get_java_source(java_file_path):
+    java_file_path = path.abspath(java_file_path)
+    mtime = os.stat(java_file_path).st_mtime
+    cached_source = JAVA_SOURCES.get(java_file_path)
+    if cached_source and cached_source[0] == mtime:
+        return cached_source[1]
+    count_profile_event('java_files_scanned')
+    with profile_step('parse_java_source'):
+        java_source = parse_java_source(java_file_path)
+    JAVA_SOURCES[java_file_path] = (mtime, java_source)
+    return java_source
+
+
 def is_interface_file(file):
     if not args.split_interfaces:
         return False
-    with open(file, 'r') as java_file:
-        for line in java_file.readlines():
-            if INTERFACE_DECLARATION.match(line):
-                return True
-    return False
+    return get_java_source(file).is_interface
 
 
 def get_interface_files(root, files):
@@ -177,371 +660,2120 @@ def get_interface_files(root, files):
     for file in (x for x in files if x.endswith('.java')):
         if is_interface_file(path.join(root, file)):
             interface_files.add(file)
-            break
     return interface_files
 
 
-def get_deps_for_files(root,
-                       files,
-                       src_roots,
-                       rule_name,
-                       third_party_map,
-                       android_libraries):
+def get_java_references(java_file_path):
+    """
+    Returns the capitalized identifiers a java file uses outside imports,
+    comments and strings, i.e. the classes it may refer to, and those of
+    them used in public or protected declarations, which are part of its
+    ABI. Everything an interface refers to is part of its ABI.
+    """
+    java_file_path = path.abspath(java_file_path)
+    mtime = os.stat(java_file_path).st_mtime
+    cached_references = JAVA_REFERENCES.get(java_file_path)
+    if cached_references and cached_references[0] == mtime:
+        return cached_references[1]
+    with profile_step('parse_java_references'):
+        with open(java_file_path, 'r') as java_file:
+            contents = JAVA_IMPORT_STATEMENT.sub(
+                ' ', JAVA_COMMENT_OR_STRING.sub(' ', java_file.read()))
+        references = frozenset(JAVA_CLASS_REFERENCE.findall(contents))
+        if get_java_source(java_file_path).is_interface:
+            exported_references = references
+        else:
+            exported_references = frozenset(
+                reference
+                for declaration in JAVA_PUBLIC_DECLARATION.findall(contents)
+                for reference in JAVA_CLASS_REFERENCE.findall(declaration))
+    java_references = JavaReferences(references, exported_references)
+    JAVA_REFERENCES[java_file_path] = (mtime, java_references)
+    return java_references
+
+
+def split_package_classes(root, java_files):
+    """
+    Splits a package into a rule for each cycle of classes that refer to
+    each other and a rule for each class outside a cycle, so that interfaces
+    and leaf classes get rules of their own. Returns (rule name, files,
+    names of the package's rules it depends on) for each rule, with the
+    rules each one depends on listed before it. The rules of a package
+    form no cycles, so splitting it can't add any.
+    """
+    class_files = {x[:-len('.java')]: x for x in java_files}
+    graph = {}
+    for class_name, java_file in class_files.iteritems():
+        graph[class_name] = set(
+            x for x in get_java_references(
+                path.join(root, java_file)).references
+            if x in class_files and x != class_name)
+    components = find_strongly_connected_components(graph, min_size=1)
+    if len(components) <= 1:
+        return [(path.basename(root), sorted(java_files), set())]
+
+    rule_names = {}
+    for component in components:
+        for class_name in component:
+            rule_names[class_name] = '{0}-{1}'.format(path.basename(root),
+                                                      component[0])
+    rules = []
+    for component in components:
+        rule_name = rule_names[component[0]]
+        package_deps = set(rule_names[dep]
+                           for class_name in component
+                           for dep in graph[class_name])
+        package_deps.discard(rule_name)
+        rules.append((rule_name,
+                      sorted(class_files[x] for x in component),
+                      package_deps))
+    return rules
+
+
+def get_rule_names_for_files(root, java_files):
+    if args.split_classes:
+        return {java_file: rule_name
+                for rule_name, files, _ in split_package_classes(root,
+                                                                 java_files)
+                for java_file in files}
+    interface_files = get_interface_files(root, java_files)
+    return {x: path.basename(root) + (INTERFACE_SUFFIX
+                                      if x in interface_files else '')
+            for x in java_files}
+
+
+def get_target_directory(target):
+    return target.lstrip('/').split(':')[0]
+
+
+def is_target_in_package(target, root):
+    return path.abspath(get_target_directory(target)) == path.abspath(root)
+
+
+def split_class_name(class_name):
+    """
+    Splits a class name into its package and its class, nested classes
+    included, at the first capitalized part. Names that have none split at
+    the last dot. Either way, a class and the classes nested in it or next
+    to it in its package end up in the same package.
+    """
+    match = CLASS_NAME_START.search(class_name)
+    if not match:
+        package, _, name = class_name.rpartition('.')
+        return package, name
+    return class_name[:match.start()], class_name[match.end():]
+
+
+def add_classes_to_index(packages, target, classes):
+    """
+    Groups the classes of target by package into packages, for
+    create_class_index, as the newline separated names of its classes in
+    each package. Each package name is stored once however many classes
+    it has.
+    """
+    target_packages = {}
+    for class_name in classes:
+        if isinstance(class_name, unicode):
+            class_name = class_name.encode('utf-8')
+        package, name = split_class_name(class_name)
+        target_packages.setdefault(package, []).append(name)
+    for package, names in target_packages.iteritems():
+        packages.setdefault(intern(package), []).append(
+            (target, '\n{0}\n'.format('\n'.join(names))))
+
+
+def create_class_index(packages, first_wins=False):
+    """
+    Turns packages from add_classes_to_index into a ClassIndex, emptying it
+    as it goes. A class added for more than one target belongs to the last
+    one, or to the first one if first_wins is set.
+    """
+    index = {}
+    while packages:
+        package, package_classes = packages.popitem()
+        if len(package_classes) > 1:
+            if not first_wins:
+                package_classes.reverse()
+            seen_names = set()
+            names_by_target = collections.OrderedDict()
+            for target, names in package_classes:
+                names = names.strip('\n').split('\n')
+                names_by_target.setdefault(target, []).extend(
+                    x for x in names if x not in seen_names)
+                seen_names.update(names)
+            package_classes = [
+                (target, '\n{0}\n'.format('\n'.join(names)))
+                for target, names in names_by_target.iteritems()
+                if names]
+        index[package] = tuple(package_classes)
+    return ClassIndex(index)
+
+
+def has_nested_class(names, prefix):
+    """
+    Returns whether names holds a class directly under prefix, which is
+    either empty or ends with a dot.
+    """
+    start = names.find('\n' + prefix)
+    while start != -1:
+        end = names.find('\n', start + 1)
+        if end == -1:
+            break
+        if '.' not in names[start + 1 + len(prefix):end]:
+            return True
+        start = names.find('\n' + prefix, end)
+    return False
+
+
+def get_package_targets(class_index, package):
+    """
+    Returns the targets with classes directly in package, which may also
+    be a class when importing all the classes nested in it.
+    """
+    package, prefix = split_class_name(package + '.*')
+    prefix = prefix[:-len('*')]
+    return [target for target, names in class_index.packages.get(package, ())
+            if has_nested_class(names, prefix)]
+
+
+def get_class_target(class_index, class_name):
+    package, name = split_class_name(class_name)
+    name = '\n{0}\n'.format(name)
+    for target, names in class_index.packages.get(package, ()):
+        if name in names:
+            return target
+    return None
+
+
+def create_source_class_index(buckconfig, src_roots):
+    """
+    Maps every class under src_roots to the rule that will own it, in one
+    walk of the source roots. Earlier source roots win, as they do in buck.
+    """
+    packages = {}
+    for src_root in src_roots:
+        src_root = path.join(path.dirname(buckconfig), src_root.lstrip('/'))
+        for root, dirs, files in os.walk(src_root):
+            java_files = [x for x in files if x.endswith('.java')]
+            if not java_files:
+                continue
+            package = path.relpath(root, src_root).replace(os.sep, '.')
+            rule_names = get_rule_names_for_files(root, java_files)
+            classes_by_target = collections.OrderedDict()
+            for java_file in java_files:
+                class_name = java_file[:-len('.java')]
+                if package != '.':
+                    class_name = package + '.' + class_name
+                classes_by_target.setdefault('//{0}:{1}'.format(
+                    path.relpath(root), rule_names[java_file]), []).append(
+                        class_name)
+            for target, classes in classes_by_target.iteritems():
+                add_classes_to_index(packages, target, classes)
+    return create_class_index(packages, first_wins=True)
+
+
+def resolve_import(needed_class, class_indexes):
+    """
+    Returns the targets providing an import, checking class_indexes in
+    order. Static imports and nested classes resolve to the outermost class
+    that is indexed, and wildcard imports to every target in the package.
+    """
+    if needed_class.startswith('static '):
+        needed_class = needed_class[len('static '):].strip()
+    if needed_class.endswith('.*'):
+        needed_class = needed_class[:-len('.*')]
+        for class_index in class_indexes:
+            targets = get_package_targets(class_index, needed_class)
+            if targets:
+                return set(targets)
+
+    while needed_class:
+        for class_index in class_indexes:
+            target = get_class_target(class_index, needed_class)
+            if target:
+                return {target}
+        needed_class = needed_class.rpartition('.')[0]
+    return set()
+
+
+def get_imports_for_files(root, files):
+    imports = set()
+    for file in (x for x in files if x.endswith('.java')):
+        imports.update(get_java_source(path.join(root, file)).imports)
+    return imports
+
+
+def get_exported_imports_for_files(root, files, package_files):
+    """
+    Returns the imports of files used in their public or protected
+    declarations. A wildcard import is exported when a declaration uses a
+    class that no single class import or file of the package accounts for.
+    """
+    exported_imports = set()
+    package_classes = set(x[:-len('.java')] for x in package_files
+                          if x.endswith('.java'))
+    for file in (x for x in files if x.endswith('.java')):
+        java_file_path = path.join(root, file)
+        references = get_java_references(java_file_path)
+        imported_classes = set()
+        wildcard_imports = []
+        for needed_class in get_java_source(java_file_path).imports:
+            class_name = needed_class.rpartition('.')[2]
+            if needed_class.endswith('.*'):
+                wildcard_imports.append(needed_class)
+            elif (not needed_class.startswith('static ') and
+                    class_name[:1].isupper()):
+                imported_classes.add(class_name)
+                if class_name in references.exported_references:
+                    exported_imports.add(needed_class)
+        if references.exported_references.difference(imported_classes,
+                                                      package_classes):
+            exported_imports.update(wildcard_imports)
+    return exported_imports
+
+
+def get_class_name(internal_name):
+    if internal_name.startswith('['):
+        match = CLASS_DESCRIPTOR_REFERENCE.search(internal_name)
+        if not match:
+            return None
+        internal_name = match.group(1)
+    return internal_name.replace('/', '.').replace('$', '.')
+
+
+def parse_class_file(contents):
+    """
+    Reads the class references out of a compiled class: its constant pool
+    classes and the types in its descriptors and generic signatures. Those
+    in its supertypes and in the descriptors of its public or protected
+    members are its ABI, if it is public. Returns the package, the source
+    file it was compiled from, its references and its ABI references.
+    """
+    if struct.unpack_from('>I', contents)[0] != CLASS_FILE_MAGIC:
+        return None
+    constant_count = struct.unpack_from('>H', contents, 8)[0]
+    utf8 = {}
+    classes = {}
+    strings = set()
+    offset = 10
+    index = 1
+    while index < constant_count:
+        tag = ord(contents[offset])
+        if tag == 1:
+            length = struct.unpack_from('>H', contents, offset + 1)[0]
+            utf8[index] = contents[offset + 3:offset + 3 + length]
+            offset += 3 + length
+        else:
+            if tag == 7:
+                classes[index] = struct.unpack_from('>H', contents,
+                                                    offset + 1)[0]
+            elif tag == 8:
+                strings.add(struct.unpack_from('>H', contents, offset + 1)[0])
+            offset += 1 + CONSTANT_POOL_SIZES[tag]
+        index += 2 if tag in (5, 6) else 1
+
+    def get_descriptor_classes(descriptor):
+        return set(get_class_name(x)
+                   for x in CLASS_DESCRIPTOR_REFERENCE.findall(descriptor))
+
+    access_flags, this_class, super_class, interface_count = \
+        struct.unpack_from('>HHHH', contents, offset)
+    offset += 8
+    supertypes = [super_class] + list(struct.unpack_from(
+        '>' + 'H' * interface_count, contents, offset))
+    offset += 2 * interface_count
+    exported_references = set()
+    if access_flags & ACC_PUBLIC:
+        exported_references.update(get_class_name(utf8[classes[x]])
+                                   for x in supertypes if x)
+
+    for _ in xrange(2):
+        member_count = struct.unpack_from('>H', contents, offset)[0]
+        offset += 2
+        for _ in xrange(member_count):
+            member_access, _, descriptor, attribute_count = \
+                struct.unpack_from('>HHHH', contents, offset)
+            offset += 8
+            for _ in xrange(attribute_count):
+                offset += 6 + struct.unpack_from('>I', contents,
+                                                 offset + 2)[0]
+            if (access_flags & ACC_PUBLIC and
+                    member_access & (ACC_PUBLIC | ACC_PROTECTED)):
+                exported_references.update(
+                    get_descriptor_classes(utf8[descriptor]))
+
+    source_file = None
+    attribute_count = struct.unpack_from('>H', contents, offset)[0]
+    offset += 2
+    for _ in xrange(attribute_count):
+        name, length = struct.unpack_from('>HI', contents, offset)
+        if utf8.get(name) == 'SourceFile':
+            source_file = utf8[struct.unpack_from('>H', contents,
+                                                  offset + 6)[0]]
+        offset += 6 + length
+
+    references = set(get_class_name(utf8[x]) for x in classes.itervalues())
+    for index, value in utf8.iteritems():
+        if index not in strings and ';' in value:
+            references.update(get_descriptor_classes(value))
+    references.discard(None)
+    exported_references.discard(None)
+    package = utf8[classes[this_class]].rpartition('/')[0].replace('/', '.')
+    return package, source_file, references, exported_references
+
+
+def get_class_output_dirs(src_root):
+    parts = src_root.strip('/').split('/')
+    module = parts[:parts.index('src')] if 'src' in parts else parts[:-1]
+    return [path.join(*(module + [x])) for x in CLASS_OUTPUT_DIRS]
+
+
+def create_bytecode_index(buckconfig, src_roots):
+    """
+    Reads every class gradle compiled for the modules of src_roots. Each
+    src root is mapped to the index of its module, which maps (package,
+    source file) to the classes its classes refer to, so that modules with
+    the same file in the same package don't share references. The oldest
+    class file's mtime is kept, to tell when the source changed after the
+    last gradle build.
+    """
+    bytecode_index = {}
+    module_indexes = {}
+    for src_root in src_roots:
+        src_root_dir = path.normpath(
+            path.join(path.dirname(buckconfig), src_root.lstrip('/')))
+        class_dirs = tuple(path.join(path.dirname(buckconfig), x)
+                           for x in get_class_output_dirs(src_root))
+        if class_dirs in module_indexes:
+            bytecode_index[src_root_dir] = module_indexes[class_dirs]
+            continue
+        module_index = {}
+        module_indexes[class_dirs] = module_index
+        bytecode_index[src_root_dir] = module_index
+        for class_dir in class_dirs:
+            if not path.isdir(class_dir):
+                continue
+            for root, dirs, files in os.walk(class_dir):
+                for class_file in (x for x in files if x.endswith('.class')):
+                    class_file_path = path.join(root, class_file)
+                    count_profile_event('class_files_scanned')
+                    with profile_step('parse_class_file'):
+                        with open(class_file_path, 'rb') as class_contents:
+                            parsed_class = parse_class_file(
+                                class_contents.read())
+                    if not parsed_class or not parsed_class[1]:
+                        continue
+                    package, source_file, references, exported_references = \
+                        parsed_class
+                    key = (package, source_file)
+                    mtime = os.stat(class_file_path).st_mtime
+                    previous = module_index.get(key)
+                    if previous:
+                        mtime = min(mtime, previous.mtime)
+                        references.update(previous.references)
+                        exported_references.update(
+                            previous.exported_references)
+                    module_index[key] = BytecodeReferences(
+                        mtime, references, exported_references)
+    return bytecode_index
+
+
+def get_module_bytecode_index(bytecode_index, root):
+    """
+    Returns the bytecode index of the module whose src root holds root, or
+    an empty one when root isn't under any of them.
+    """
+    root = path.normpath(root)
+    src_root_dirs = [x for x in bytecode_index
+                     if root == x or root.startswith(x + os.sep)]
+    if not src_root_dirs:
+        return {}
+    return bytecode_index[max(src_root_dirs, key=len)]
+
+
+def get_bytecode_imports_for_files(root, files, package_files):
+    """
+    Adds the classes that gradle compiled from files refer to to their
+    imports. Imports are still needed for the constants and source-only
+    annotations that javac leaves out of the class files. Files that
+    weren't compiled, or were changed since, only use their imports.
+    """
+    bytecode_index = get_module_bytecode_index(
+        PACKAGE_ANALYSIS.get('bytecode_index', {}), root)
+    imports = get_imports_for_files(root, files)
+    exported_imports = set()
+    if args.prune_deps:
+        exported_imports = get_exported_imports_for_files(root,
+                                                          files,
+                                                          package_files)
+    for file in (x for x in files if x.endswith('.java')):
+        java_file_path = path.join(root, file)
+        compiled_file = bytecode_index.get(
+            (get_java_source(java_file_path).package or '', file))
+        if (compiled_file and
+                compiled_file.mtime >= os.stat(java_file_path).st_mtime):
+            imports.update(compiled_file.references)
+            exported_imports.update(compiled_file.exported_references)
+    return imports, exported_imports
+
+
+def get_deps_for_imports(root,
+                         imports,
+                         rule_name,
+                         class_indexes,
+                         android_libraries):
     deps = set()
     has_android_deps = False
-    for file in (x for x in files if x.endswith('.java')):
-        with open(path.join(root, file), 'r') as java_file:
-            for line in java_file.readlines():
-                match = JAVA_IMPORT.match(line)
-                if match:
-                    needed_class = match.group(1)
-                    if (needed_class.startswith('android') or
-                            needed_class.startswith('com.android')):
-                        has_android_deps = True
-                    if needed_class in third_party_map:
-                        deps.add(third_party_map[needed_class])
-                    else:
-                        java_file = needed_class.replace('.', '/') + '.java'
-                        for src_root in src_roots:
-                            src_root = src_root.lstrip('/')
-                            java_file_full_path = path.join(
-                                src_root, java_file)
-                            if path.exists(java_file_full_path):
-                                target_basename = path.join(
-                                    src_root,
-                                    path.dirname(java_file))
-                                rule_name = path.basename(
-                                    path.dirname(java_file))
-                                if is_interface_file(java_file_full_path):
-                                    rule_name += INTERFACE_SUFFIX
-                                target = '//{0}:{1}'.format(
-                                    target_basename,
-                                    rule_name)
-                                if (path.abspath(target_basename) !=
-                                        path.abspath(root)):
-                                    deps.add(target)
-                                    if target in android_libraries:
-                                        has_android_deps = True
-                                break
+    for needed_class in imports:
+        if needed_class.startswith('static '):
+            needed_class = needed_class[len('static '):].strip()
+        if (needed_class.startswith('android') or
+                needed_class.startswith('com.android')):
+            has_android_deps = True
+        for target in resolve_import(needed_class, class_indexes):
+            if not is_target_in_package(target, root):
+                deps.add(target)
+                if target in android_libraries:
+                    has_android_deps = True
     if has_android_deps:
         android_libraries.add(rule_name)
     return deps, has_android_deps
 
 
-def generate_default_buck_files(buckconfig,
-                                src_roots,
-                                third_party_map,
-                                android_libraries,
-                                default_library_type):
-    buck_files = []
+def get_deps_for_files(root,
+                       files,
+                       rule_name,
+                       class_indexes,
+                       android_libraries):
+    return get_deps_for_imports(root,
+                                get_imports_for_files(root, files),
+                                rule_name,
+                                class_indexes,
+                                android_libraries)
+
+
+def get_java_packages(buckconfig, src_roots):
+    packages = []
+    seen_roots = set()
     for src_root in src_roots:
         src_root = src_root.lstrip('/')
         path_walker = os.walk(path.join(path.dirname(buckconfig), src_root))
         for root, dirs, files in path_walker:
-            if 'BUCK' not in files and any((x for x in files if
-                                            x.endswith('.java'))):
-                interface_files = get_interface_files(root, files)
-                with open(path.join(root, 'BUCK'), 'w') as buck_file:
-                    if interface_files:
-                        buck_file.write(INTERFACE_FILES_TEMPLATE.format(
-                            ', \n'.join(("  '%s'" % x for x in
-                                         interface_files))
-                        ))
-                        interface_rule = path.basename(root) + INTERFACE_SUFFIX
-                        interface_buck_rule = '//{0}:{1}-interfaces'.format(
-                            path.relpath(root),
-                            path.basename(root))
-                        interface_deps, has_android_deps = get_deps_for_files(
-                            root,
-                            interface_files,
-                            src_roots,
-                            interface_buck_rule,
-                            third_party_map,
-                            android_libraries)
-                        interface_library_type = default_library_type
-                        if has_android_deps:
-                            interface_library_type = 'android_library'
-
-                        buck_file.write(
-                            BUCK_FILE_TEMPLATE.format(
-                                library_type=interface_library_type,
-                                sources='INTERFACE_FILES',
-                                name=interface_rule,
-                                deps='\n'.join(
-                                    format_deps_for_buck_file(interface_deps))
-                            ))
-                        buck_files.append(interface_buck_rule)
-                    main_buck_rule = '//{0}:{1}'.format(
-                        path.relpath(root),
-                        path.basename(root))
-                    main_rule_deps, has_android_deps = get_deps_for_files(
-                        root,
-                        set(files).difference(
-                            interface_files),
-                        src_roots,
-                        main_buck_rule,
-                        third_party_map,
-                        android_libraries)
-                    main_library_type = default_library_type
-                    if has_android_deps:
-                        main_library_type = 'android_library'
-                    main_rule_srcs = "glob(['*.java'])"
-                    if interface_files:
-                        main_rule_srcs = "glob(['*.java'], " \
-                                         "excludes=INTERFACE_FILES)"
-                    buck_file.write(
-                        BUCK_FILE_TEMPLATE.format(
-                            library_type=main_library_type,
-                            sources=main_rule_srcs,
-                            name=path.basename(root),
-                            deps='\n'.join(
-                                format_deps_for_buck_file(
-                                    main_rule_deps))
-                        ))
-                    buck_files.append(main_buck_rule)
+            if (root not in seen_roots and
+                    any((x for x in files if x.endswith('.java')))):
+                seen_roots.add(root)
+                packages.append((root, files))
+    return packages
+
+
+def get_packages_to_generate(buckconfig, src_roots):
+    return [(root, files)
+            for root, files in get_java_packages(buckconfig, src_roots)
+            if 'BUCK' not in files]
+
+
+def create_package_rule(root,
+                        rule_name,
+                        sources,
+                        files,
+                        package_files,
+                        class_indexes):
+    buck_rule = '//{0}:{1}'.format(path.relpath(root), rule_name)
+    if args.bytecode:
+        imports, exported_imports = get_bytecode_imports_for_files(
+            root, files, package_files)
+        if not args.prune_deps:
+            exported_imports = set()
+    else:
+        imports = get_imports_for_files(root, files)
+        exported_imports = set()
+        if args.prune_deps:
+            exported_imports = get_exported_imports_for_files(root,
+                                                              files,
+                                                              package_files)
+    deps, has_android_deps = get_deps_for_imports(root,
+                                                  imports,
+                                                  buck_rule,
+                                                  class_indexes,
+                                                  set())
+    exported_deps, _ = get_deps_for_imports(root,
+                                            exported_imports,
+                                            buck_rule,
+                                            class_indexes,
+                                            set())
+    return PackageRule(buck_rule,
+                       rule_name,
+                       sources,
+                       deps,
+                       has_android_deps,
+                       imports,
+                       exported_deps,
+                       exported_imports)
+
+
+def analyze_package(root, files, class_indexes):
+    """
+    Works out the rules for one package. Whether a rule must be an
+    android_library because of the rules it depends on is left to
+    plan_package_buck_file, since that depends on the packages before it.
+    """
+    if args.split_classes:
+        return [], analyze_split_package(root, files, class_indexes)
+    rules = []
+    interface_files = get_interface_files(root, files)
+    if interface_files:
+        rules.append(create_package_rule(
+            root,
+            path.basename(root) + INTERFACE_SUFFIX,
+            'INTERFACE_FILES',
+            interface_files,
+            files,
+            class_indexes))
+
+    main_rule_srcs = "glob(['*.java'])"
+    if interface_files:
+        main_rule_srcs = "glob(['*.java'], excludes=INTERFACE_FILES)"
+    rules.append(create_package_rule(
+        root,
+        path.basename(root),
+        main_rule_srcs,
+        set(files).difference(interface_files),
+        files,
+        class_indexes))
+    return sorted(interface_files), rules
+
+
+def analyze_split_package(root, files, class_indexes):
+    rules = []
+    java_files = [x for x in files if x.endswith('.java')]
+    package_rules = split_package_classes(root, java_files)
+    rule_names = {java_file[:-len('.java')]: rule_name
+                  for rule_name, rule_files, _ in package_rules
+                  for java_file in rule_files}
+    for rule_name, rule_files, package_deps in package_rules:
+        sources = "glob(['*.java'])"
+        if len(package_rules) > 1:
+            sources = '[{0}]'.format(', '.join("'{0}'".format(x)
+                                               for x in rule_files))
+        rule = create_package_rule(root,
+                                   rule_name,
+                                   sources,
+                                   rule_files,
+                                   java_files,
+                                   class_indexes)
+        rule.deps.update('//{0}:{1}'.format(path.relpath(root), x)
+                         for x in package_deps)
+        if args.prune_deps:
+            rule.exported_deps.update(
+                '//{0}:{1}'.format(path.relpath(root), rule_names[x])
+                for java_file in rule_files
+                for x in get_java_references(
+                    path.join(root, java_file)).exported_references
+                if rule_names.get(x, rule_name) != rule_name)
+        rules.append(rule)
+    return rules
+
+
+def init_package_analysis(class_indexes, options, bytecode_index):
+    global args
+    args = options
+    PACKAGE_ANALYSIS['class_indexes'] = class_indexes
+    PACKAGE_ANALYSIS['bytecode_index'] = bytecode_index
+
+
+def analyze_package_in_worker(package):
+    root, files = package
+    return analyze_package(root, files, PACKAGE_ANALYSIS['class_indexes'])
+
+
+def plan_package_buck_file(plan,
+                           root,
+                           interface_files,
+                           rules,
+                           android_libraries,
+                           default_library_type):
+    buck_file = []
+    if interface_files:
+        buck_file.append(INTERFACE_FILES_TEMPLATE.format(
+            ', \n'.join(("  '%s'" % x for x in interface_files))
+        ))
+    for rule in rules:
+        library_type = default_library_type
+        if rule.has_android_deps or any(
+                dep in android_libraries for dep in rule.deps):
+            library_type = 'android_library'
+            android_libraries.add(rule.target)
+        exported_deps = ''
+        if rule.exported_deps:
+            exported_deps = EXPORTED_DEPS_TEMPLATE.format('\n'.join(
+                format_deps_for_buck_file(rule.exported_deps)))
+        buck_file.append(
+            BUCK_FILE_TEMPLATE.format(
+                library_type=library_type,
+                sources=rule.sources,
+                name=rule.name,
+                deps='\n'.join(format_deps_for_buck_file(rule.deps)),
+                exported_deps=exported_deps,
+            ))
+        plan.rules[rule.target] = {
+            'type': library_type,
+            'srcs': rule.sources,
+            'deps': sorted(rule.deps),
+        }
+        if rule.exported_deps:
+            plan.rules[rule.target]['exported_deps'] = sorted(
+                rule.exported_deps)
+    plan.files[path.join(root, 'BUCK')] = ''.join(buck_file)
+
+
+def analyze_packages(packages, class_indexes, jobs=1):
+    """
+    Analyzes packages in order. With jobs > 1 they are analyzed by a process
+    pool, which inherits the class indexes once when it starts.
+    """
+    if jobs <= 1:
+        return [analyze_package(root, files, class_indexes)
+                for root, files in packages]
+    pool = multiprocessing.Pool(jobs,
+                                initializer=init_package_analysis,
+                                initargs=(class_indexes,
+                                          args,
+                                          PACKAGE_ANALYSIS.get(
+                                              'bytecode_index', {})))
+    try:
+        return pool.map(analyze_package_in_worker, packages, chunksize=16)
+    finally:
+        pool.close()
+        pool.join()
 
-    return buck_files
 
+def create_class_indexes(buckconfig, src_roots, third_party_map):
+    return [
+        third_party_map,
+        create_source_class_index(buckconfig, src_roots),
+    ]
+
+
+def get_java_file_hashes(root, files, previous_hashes):
+    """
+    Returns [mtime, sha1] for each java file of a package, only reading the
+    files whose mtime changed since previous_hashes was recorded.
+    """
+    hashes = {}
+    for java_file in (x for x in files if x.endswith('.java')):
+        java_file_path = path.join(root, java_file)
+        mtime = os.stat(java_file_path).st_mtime
+        previous_hash = previous_hashes.get(java_file)
+        if previous_hash and previous_hash[0] == mtime:
+            hashes[java_file] = previous_hash
+            continue
+        with open(java_file_path, 'rb') as java_file_contents:
+            hashes[java_file] = [
+                mtime,
+                hashlib.sha1(java_file_contents.read()).hexdigest()]
+    return hashes
 
-def get_maven_coordinates(gradle_files, gradle_cache):
-    maven_coordinates = {}
-    for gradle_file in gradle_files:
-        maven_coordinates.update(
-            get_maven_coordinates_for_gradle_file(gradle_file, gradle_cache))
-    return maven_coordinates
 
+def has_package_changed(java_file_hashes, previous_hashes):
+    return ({name: x[1] for name, x in java_file_hashes.iteritems()} !=
+            {name: x[1] for name, x in previous_hashes.iteritems()})
 
-def get_maven_coordinates_for_gradle_file(gradle_file_path, gradle_cache):
-    maven_coordinates = {}
-    with open(gradle_file_path, 'r') as gradle_file:
-        for line in gradle_file.readlines():
-            match = THIRD_PARTY_JAR.match(line)
-            if match:
-                coordinate_match = MAVEN_COORDINATE.match(match.group(1))
-                if coordinate_match:
-                    prebuilt_type = 'prebuilt_jar'
-                    binary_field = 'binary_jar'
-                    group = coordinate_match.group(1)
-                    dep_id = coordinate_match.group(2)
-                    repo = 'mvn'
-                    local_maven_repository = None
-
-                    if coordinate_match.group(3):
-                        dep_type = coordinate_match.group(3).rstrip(':')
-                    else:
-                        if group.startswith('com.google.android'):
-                            local_maven_repository = path.join(
-                                path.expandvars('$ANDROID_HOME'),
-                                'extras/google/m2repository/')
-                        elif group.startswith('com.android'):
-                            local_maven_repository = path.join(
-                                path.expandvars('$ANDROID_HOME'),
-                                'extras/android/m2repository/')
-                        else:
-                            dep_type = 'jar'
-
-                    version = coordinate_match.group(4)
-
-                    dep_hash = None
-                    if local_maven_repository:
-                        maven_path = path.join(
-                            local_maven_repository,
-                            group.replace('.', '/'),
-                            dep_id,
-                            version
-                        )
-
-                        for possible_type in POSSIBLE_MAVEN_TYPES:
-                            maven_sha = path.join(maven_path,
-                                                  '{dep_id}-{version}.{type}'
-                                                  '.sha1'
-                                                  .format(
-                                                      dep_id=dep_id,
-                                                      version=version,
-                                                      type=possible_type[0],
-                                                  ))
-                            if path.exists(maven_sha):
-                                with open(maven_sha, 'r') as maven_sha_file:
-                                    dep_type = possible_type[0]
-                                    prebuilt_type = possible_type[1]
-                                    binary_field = possible_type[2]
-                                    dep_hash = maven_sha_file.read()
-                    else:
-                        for possible_type in POSSIBLE_MAVEN_TYPES:
-                            expected_file = path.join(
-                                '{dep_id}-{version}.{type}'
-                                .format(
-                                    dep_id=dep_id,
-                                    version=version,
-                                    type=possible_type[0],
-                                ))
-                            walker = os.walk(gradle_cache)
-                            for root, dirs, files in walker:
-                                if dep_hash:
-                                    del dirs[:]
-                                for child_file in files:
-                                    if child_file == expected_file:
-                                        dep_hash = path.basename(root)
-                                        dep_type = possible_type[0]
-                                        prebuilt_type = possible_type[1]
-                                        binary_field = possible_type[2]
-                                        del dirs[:]
-                    if not dep_hash:
-                        print "\tCoudn't find a hash for {0}".format(
-                            coordinate_match.group(0))
-                    else:
-                        if len(dep_hash) % 2 != 0:
-                            dep_hash = '0' + dep_hash
-                        coordinate = "{group}:{id}:{type}:{version}".format(
-                            group=group,
-                            id=dep_id,
-                            type=dep_type,
-                            version=version,
-                        )
-                        maven_coordinates[coordinate] = {
-                            'name': dep_id,
-                            'repo': repo,
-                            'prebuilt_type': prebuilt_type,
-                            'binary_field': binary_field,
-                            'coordinate': coordinate,
-                            'hash': dep_hash
-                        }
-
-                else:
-                    print "Couldn't parse maven coordiante {0}".format(
-                        match.group(1))
-    return maven_coordinates
 
+def get_planned_rule_types(plan, rules):
+    return {rule.target: plan.rules[rule.target]['type'] for rule in rules}
 
-def write_remote_deps(third_party_buck_file, maven_coordinates):
-    existing_deps = get_existing_third_party_jars()
-    if not os.path.exists(os.path.dirname(third_party_buck_file)):
-        os.makedirs(os.path.dirname(third_party_buck_file))
-    with open(third_party_buck_file, 'wa') as buck_file:
-        for maven_coordinate in maven_coordinates.values():
-            if maven_coordinate['name'] not in existing_deps:
-                buck_file.write(REMOTE_DEP_TEMPLATE.format(**maven_coordinate))
 
+def record_package_state(state, root, java_file_hashes, rules, rule_types):
+    state.setdefault('packages', {})[root] = {
+        'files': java_file_hashes,
+        'rules': {rule.target: {
+            'name': rule.name,
+            'srcs': rule.sources,
+            'type': rule_types[rule.target],
+            'imports': sorted(rule.imports),
+            'deps': sorted(rule.deps),
+            'exported_imports': sorted(rule.exported_imports),
+            'exported_deps': sorted(rule.exported_deps),
+        } for rule in rules},
+    }
 
-def get_classes_for_aar(aar):
-    temp_dir = tempfile.mkdtemp()
+
+def plan_buck_file_edits(plan):
+    """
+    Moves the in-memory edits of BUCK files into plan, so that they are
+    written, or shown by --dry_run, along with the planned files.
+    """
+    for buck_file, model in BUCK_FILES.iteritems():
+        if model['dirty']:
+            plan.files[buck_file] = format_buck_file(model)
+            model['dirty'] = False
+
+
+def generate_default_buck_files(buckconfig,
+                                src_roots,
+                                third_party_map,
+                                android_libraries,
+                                default_library_type,
+                                jobs=1,
+                                plan=None,
+                                state=None):
+    """
+    Plans a BUCK file for every package under src_roots that doesn't have
+    one, writing them all at the end unless a plan to add them to is given.
+    The files are planned in walk order, so the output doesn't depend on
+    jobs. When state is given, the hashes and imports of every generated
+    package are recorded in it for --incremental.
+    """
+    write_plan = plan is None
+    if write_plan:
+        plan = create_buck_plan()
+    buck_files = []
+    class_indexes = create_class_indexes(buckconfig,
+                                         src_roots,
+                                         third_party_map)
+    packages = get_packages_to_generate(buckconfig, src_roots)
+    analyzed_packages = analyze_packages(packages, class_indexes, jobs)
+    for (root, files), (interface_files, rules) in zip(packages,
+                                                       analyzed_packages):
+        plan_package_buck_file(plan,
+                               root,
+                               interface_files,
+                               rules,
+                               android_libraries,
+                               default_library_type)
+        buck_files.extend(rule.target for rule in rules)
+        if state is not None:
+            record_package_state(state,
+                                 root,
+                                 get_java_file_hashes(root, files, {}),
+                                 rules,
+                                 get_planned_rule_types(plan, rules))
+
+    if write_plan:
+        write_buck_plan(plan)
+    return buck_files
+
+
+def update_rule_deps(plan, rule, old_deps, old_exported_deps, library_type):
+    """
+    Swaps the deps and, with --prune_deps, the exported deps generated last
+    time for the rule's new ones, keeping those that were added by hand or
+    by add_missing_deps. Returns whether the rule changed.
+    """
+    def update_exported_deps(x):
+        return x.difference(old_exported_deps).union(rule.exported_deps)
+
+    modified_rule = modify_buck_rule(
+        rule.target,
+        new_deps_fn=lambda x: x.difference(old_deps).union(rule.deps),
+        new_rule_type=(library_type if library_type == 'android_library'
+                       else None),
+        new_exported_deps_fn=(update_exported_deps if args.prune_deps
+                              else None))
+    if modified_rule:
+        buck_rule = get_buck_rule(rule.target)
+        plan.rules[rule.target] = {
+            'type': buck_rule['type'],
+            'srcs': rule.sources,
+            'deps': sorted(buck_rule['deps'] or ()),
+        }
+        if buck_rule['exported_deps']:
+            plan.rules[rule.target]['exported_deps'] = sorted(
+                buck_rule['exported_deps'])
+    return modified_rule
+
+
+def update_buck_files_incrementally(buckconfig,
+                                    src_roots,
+                                    third_party_map,
+                                    android_libraries,
+                                    default_library_type,
+                                    state,
+                                    jobs=1,
+                                    plan=None,
+                                    class_indexes=None,
+                                    recheck_unchanged=True):
+    """
+    Brings the BUCK files recorded in state up to date, and generates the
+    missing ones. Only packages whose java sources changed are analyzed
+    again; the other rules just resolve their recorded imports again, in
+    case the classes they point at moved, unless recheck_unchanged is False
+    because the class indexes are known not to have changed. Hand-written
+    BUCK files are left alone, as they are by generate_default_buck_files.
+    Returns the rules that were added or changed.
+    """
+    write_plan = plan is None
+    if write_plan:
+        plan = create_buck_plan()
+    if class_indexes is None:
+        class_indexes = create_class_indexes(buckconfig,
+                                             src_roots,
+                                             third_party_map)
+    previous_packages = state.get('packages', {})
+    state['packages'] = {}
+    packages = []
+    changed_packages = []
+    for root, files in get_java_packages(buckconfig, src_roots):
+        previous_package = previous_packages.get(root)
+        if previous_package is None and 'BUCK' in files:
+            continue
+        previous_hashes = (previous_package or {}).get('files', {})
+        java_file_hashes = get_java_file_hashes(root, files, previous_hashes)
+        packages.append((root, java_file_hashes, previous_package))
+        if ('BUCK' not in files or
+                has_package_changed(java_file_hashes, previous_hashes)):
+            changed_packages.append((root, files))
+    print '\t{0} of {1} packages changed'.format(len(changed_packages),
+                                                 len(packages))
+    analyzed_packages = dict(zip(
+        (root for root, _ in changed_packages),
+        analyze_packages(changed_packages, class_indexes, jobs)))
+
+    buck_rules = []
+    for root, java_file_hashes, previous_package in packages:
+        previous_rules = (previous_package or {}).get('rules', {})
+        if (root not in analyzed_packages and
+                not recheck_unchanged and
+                not any(x['type'] != 'android_library' and
+                        any(dep in android_libraries for dep in x['deps'])
+                        for x in previous_rules.itervalues())):
+            android_libraries.update(
+                target for target, previous_rule in previous_rules.iteritems()
+                if previous_rule['type'] == 'android_library')
+            state['packages'][root] = dict(previous_package,
+                                           files=java_file_hashes)
+            continue
+        elif root not in analyzed_packages:
+            rules = []
+            for target, previous_rule in sorted(previous_rules.iteritems()):
+                imports = previous_rule['imports']
+                deps, has_android_deps = get_deps_for_imports(
+                    root, imports, target, class_indexes, set())
+                exported_imports = previous_rule.get('exported_imports', [])
+                exported_deps, _ = get_deps_for_imports(
+                    root, exported_imports, target, class_indexes, set())
+                for rule_deps, previous_deps in (
+                        (deps, previous_rule['deps']),
+                        (exported_deps, previous_rule.get('exported_deps',
+                                                          []))):
+                    rule_deps.update(x for x in previous_deps
+                                     if is_target_in_package(x, root))
+                rules.append(PackageRule(target,
+                                         previous_rule['name'],
+                                         previous_rule['srcs'],
+                                         deps,
+                                         has_android_deps,
+                                         imports,
+                                         exported_deps,
+                                         exported_imports))
+        else:
+            interface_files, rules = analyzed_packages[root]
+            buck_file = path.join(root, 'BUCK')
+            if (not path.exists(buck_file) or
+                    set(previous_rules) != set(x.target for x in rules)):
+                plan_package_buck_file(plan,
+                                       root,
+                                       interface_files,
+                                       rules,
+                                       android_libraries,
+                                       default_library_type)
+                buck_rules.extend(rule.target for rule in rules)
+                record_package_state(state, root, java_file_hashes, rules,
+                                     get_planned_rule_types(plan, rules))
+                continue
+
+        rule_types = {}
+        for rule in rules:
+            previous_rule = previous_rules[rule.target]
+            library_type = previous_rule['type']
+            if rule.has_android_deps or any(
+                    dep in android_libraries for dep in rule.deps):
+                library_type = 'android_library'
+            if library_type == 'android_library':
+                android_libraries.add(rule.target)
+            rule_types[rule.target] = library_type
+            if update_rule_deps(plan,
+                                rule,
+                                previous_rule['deps'],
+                                previous_rule.get('exported_deps', ()),
+                                library_type):
+                buck_rules.append(rule.target)
+        record_package_state(state, root, java_file_hashes, rules, rule_types)
+
+    plan_buck_file_edits(plan)
+    if write_plan:
+        write_buck_plan(plan)
+    return buck_rules
+
+
+def get_java_file_mtimes(buckconfig, src_roots):
+    mtimes = {}
+    for root, files in get_java_packages(buckconfig, src_roots):
+        for java_file in (x for x in files if x.endswith('.java')):
+            java_file_path = path.join(root, java_file)
+            mtimes[java_file_path] = os.stat(java_file_path).st_mtime
+    return mtimes
+
+
+def watch_java_sources(buckconfig,
+                       src_roots,
+                       third_party_map,
+                       android_libraries,
+                       default_library_type,
+                       state,
+                       cache_dir,
+                       interval):
+    """
+    Polls src_roots for java files that are added, removed or edited, and
+    updates the affected rules with update_buck_files_incrementally until
+    interrupted. android_libraries should only hold third party rules, so
+    that every update starts from the same place as a full run. The class
+    indexes stay in memory; the source class index
+    is only rebuilt when files come and go, or when an edit could move a
+    class to another rule because of --split_interfaces or --split_classes.
+    """
+    source_class_index = create_source_class_index(buckconfig, src_roots)
+    mtimes = get_java_file_mtimes(buckconfig, src_roots)
+    print '\tWatching {0} java files, press Ctrl-C to stop'.format(
+        len(mtimes))
+    try:
+        while True:
+            time.sleep(interval)
+            new_mtimes = get_java_file_mtimes(buckconfig, src_roots)
+            if new_mtimes == mtimes:
+                continue
+            start = time.time()
+            recheck_unchanged = (set(new_mtimes) != set(mtimes) or
+                                 args.split_interfaces or
+                                 args.split_classes)
+            if recheck_unchanged:
+                source_class_index = create_source_class_index(buckconfig,
+                                                               src_roots)
+            mtimes = new_mtimes
+            buck_rules = update_buck_files_incrementally(
+                buckconfig,
+                src_roots,
+                third_party_map,
+                set(android_libraries),
+                default_library_type,
+                state,
+                class_indexes=[third_party_map, source_class_index],
+                recheck_unchanged=recheck_unchanged)
+            write_cache_file(cache_dir, INCREMENTAL_STATE, state)
+            print '\tUpdated {0} rules in {1:.0f}ms'.format(
+                len(buck_rules), (time.time() - start) * 1000)
+            for buck_rule in buck_rules:
+                print '\t\t{0}'.format(buck_rule)
+    except KeyboardInterrupt:
+        pass
+
+
+def read_cache_file(cache_dir, name):
+    cache_file = path.join(cache_dir, name)
+    if not path.exists(cache_file):
+        return None
     try:
-        with zipfile.ZipFile(aar) as aar_file:
-            try:
-                aar_file.extract('classes.jar', temp_dir)
-                return get_classes_for_jar(path.join(temp_dir, 'classes.jar'))
-            except KeyError:
-                pass
+        with open(cache_file, 'r') as cache_file_contents:
+            return json.load(cache_file_contents)
+    except ValueError:
+        return None
+
+
+def configure_cache_session(read_only=False):
+    CACHE_SESSION['read_only'] = read_only
+
+
+def write_cache_file(cache_dir, name, data):
+    if CACHE_SESSION['read_only']:
+        return
+    write_file_atomically(path.join(cache_dir, name), json.dumps(data))
+
+
+def get_gradle_cache_files_root(gradle_cache):
+    files_root = path.join(gradle_cache, GRADLE_CACHE_FILES)
+    if path.isdir(files_root):
+        return files_root
+    return gradle_cache
+
+
+def get_gradle_cache_fingerprint(files_root):
+    """
+    Hashes the mtimes of the group/artifact/version directories. Gradle adds a
+    new directory at one of those levels whenever it downloads an artifact,
+    so this is far cheaper than walking down to the files themselves.
+    """
+    fingerprint = hashlib.sha1()
+    level = [files_root]
+    for _ in xrange(GRADLE_CACHE_INDEX_DEPTH):
+        next_level = []
+        for directory in level:
+            for child in sorted(os.listdir(directory)):
+                child_path = path.join(directory, child)
+                if path.isdir(child_path):
+                    fingerprint.update('{0}:{1}\n'.format(
+                        path.relpath(child_path, files_root),
+                        os.stat(child_path).st_mtime))
+                    next_level.append(child_path)
+        level = next_level
+    return fingerprint.hexdigest()
+
+
+def get_gradle_cache_key(group, dep_id, version, dep_type):
+    return '{0}:{1}:{2}:{3}'.format(group, dep_id, version, dep_type)
+
+
+def create_gradle_cache_index(files_root):
+    """
+    Walks the gradle cache once, mapping group:id:version:type to the name of
+    the sha1 directory that holds the artifact.
+    """
+    index = {}
+    for root, dirs, files in os.walk(files_root):
+        relative_root = path.relpath(root, files_root).split(os.sep)
+        if len(relative_root) != 4:
+            continue
+        del dirs[:]
+        group, dep_id, version, dep_hash = relative_root
+        prefix = '{0}-{1}.'.format(dep_id, version)
+        for child_file in files:
+            if child_file.startswith(prefix):
+                dep_type = child_file[len(prefix):]
+                index.setdefault(
+                    get_gradle_cache_key(group, dep_id, version, dep_type),
+                    dep_hash)
+    return index
+
+
+def load_gradle_cache_index(gradle_cache, cache_dir):
+    if not path.isdir(gradle_cache):
+        return {}
+    files_root = get_gradle_cache_files_root(gradle_cache)
+    with profile_step('fingerprint_gradle_cache'):
+        fingerprint = get_gradle_cache_fingerprint(files_root)
+    cached_index = read_cache_file(cache_dir, GRADLE_CACHE_INDEX)
+    if (cached_index and
+            cached_index.get('files_root') == files_root and
+            cached_index.get('fingerprint') == fingerprint):
+        return cached_index['artifacts']
+
+    print '\tIndexing gradle cache {0}'.format(files_root)
+    with profile_step('walk_gradle_cache'):
+        index = create_gradle_cache_index(files_root)
+    write_cache_file(cache_dir, GRADLE_CACHE_INDEX, {
+        'files_root': files_root,
+        'fingerprint': fingerprint,
+        'artifacts': index,
+    })
+    return index
+
+
+def get_maven_coordinates(gradle_build_files,
+                          gradle_cache,
+                          cache_dir,
+                          jobs=1,
+                          transitive=False,
+                          artifact_index=None,
+                          export_artifact_index=False):
+    """
+    Resolves the dependencies of every build file, each distinct one once,
+    along with everything they depend on if transitive is set. With
+    jobs > 1 they are resolved by a thread pool, which mostly helps
+    artifacts from the Android SDK m2repositories that have to be hashed.
+    Dependencies already in artifact_index are taken from it, and the
+    gradle cache is only indexed if some are missing from it.
+    """
+    dependencies = collections.OrderedDict()
+    for gradle_build_file in gradle_build_files:
+        for dependency in gradle_build_file.dependencies:
+            dependencies.setdefault(normalize_dependency(dependency),
+                                    dependency)
+    gradle_cache_index = None
+    if transitive:
+        gradle_cache_index = load_gradle_cache_index(gradle_cache, cache_dir)
+        dependencies = add_transitive_dependencies(
+            dependencies,
+            gradle_cache_index,
+            get_gradle_cache_files_root(gradle_cache))
+
+    maven_coordinates = {}
+    if artifact_index:
+        with profile_step('read_artifact_index'):
+            for key, dependency in dependencies.items():
+                maven_coordinate = get_indexed_maven_coordinate(
+                    artifact_index, dependency)
+                if maven_coordinate:
+                    count_profile_event('artifact_index_hits')
+                    maven_coordinates[maven_coordinate['coordinate']] = \
+                        maven_coordinate
+                    del dependencies[key]
+    if dependencies and gradle_cache_index is None:
+        gradle_cache_index = load_gradle_cache_index(gradle_cache, cache_dir)
+    m2repository_index = read_cache_file(cache_dir, M2REPOSITORY_INDEX) or {}
+
+    def resolve(dependency):
+        return get_maven_coordinate(dependency,
+                                    gradle_cache_index,
+                                    m2repository_index)
+
+    pool = ThreadPool(max(jobs, 1))
+    try:
+        results = pool.map(resolve, dependencies.values())
     finally:
-        shutil.rmtree(temp_dir)
-    return []
+        pool.close()
+
+    new_m2repository_entries = {}
+    for maven_coordinate, m2repository_entry, error in results:
+        if error:
+            print error
+        if maven_coordinate:
+            coordinate = maven_coordinate['coordinate']
+            maven_coordinates[coordinate] = maven_coordinate
+            if artifact_index and export_artifact_index:
+                update_artifact_index_entry(artifact_index,
+                                            coordinate,
+                                            maven_coordinate['hash'])
+        if m2repository_entry:
+            new_m2repository_entries.update(m2repository_entry)
+    if new_m2repository_entries:
+        m2repository_index.update(new_m2repository_entries)
+        write_cache_file(cache_dir, M2REPOSITORY_INDEX, m2repository_index)
+    return maven_coordinates
 
 
-def get_classes_for_jar(jar):
-    jar_output = subprocess.check_output(['jar', 'tvf', jar])
+def get_version_key(version):
+    """
+    Orders versions the way gradle does for conflicts, closely enough:
+    numbers compare numerically, and a qualifier such as -rc1 or -SNAPSHOT
+    sorts before the release it qualifies.
+    """
+    key = [(1, int(x), '') if x.isdigit() else (-1, 0, x)
+           for x in re.split(r'[.-]', version) if x]
+    key.append((0, 0, ''))
+    return key
+
+
+def get_pom_child(element, name):
+    for child in (element if element is not None else ()):
+        if child.tag.split('}')[-1] == name:
+            return child
+    return None
+
+
+def get_pom_children(element, name):
+    child = get_pom_child(element, name)
+    return list(child) if child is not None else []
+
+
+def get_pom_text(element, name):
+    child = get_pom_child(element, name)
+    if child is None or not child.text:
+        return None
+    return child.text.strip()
+
+
+def find_pom_file(group, dep_id, version, gradle_cache_index, files_root):
+    dep_hash = gradle_cache_index.get(
+        get_gradle_cache_key(group, dep_id, version, 'pom'))
+    if dep_hash:
+        return path.join(files_root,
+                         group,
+                         dep_id,
+                         version,
+                         dep_hash,
+                         '{0}-{1}.pom'.format(dep_id, version))
+    local_maven_repository = get_local_maven_repository(group)
+    if local_maven_repository:
+        pom_file = path.join(
+            get_local_maven_path(local_maven_repository,
+                                 group,
+                                 dep_id,
+                                 version),
+            '{0}-{1}.pom'.format(dep_id, version))
+        if path.exists(pom_file):
+            return pom_file
+    return None
+
+
+def parse_pom_file(pom_file, get_parent_pom):
+    """
+    Reads the dependencies of a pom, with the properties, groupId, version
+    and dependencyManagement versions it inherits from its parents filled
+    in. Test, provided and optional dependencies are left out.
+    """
+    root = xml.parse(pom_file).getroot()
+    properties = {}
+    managed_versions = {}
+    group = get_pom_text(root, 'groupId')
+    version = get_pom_text(root, 'version')
+
+    parent = get_pom_child(root, 'parent')
+    if parent is not None:
+        parent_pom = get_parent_pom(get_pom_text(parent, 'groupId'),
+                                    get_pom_text(parent, 'artifactId'),
+                                    get_pom_text(parent, 'version'))
+        if parent_pom:
+            properties.update(parent_pom['properties'])
+            managed_versions.update(parent_pom['managed_versions'])
+        group = group or get_pom_text(parent, 'groupId')
+        version = version or get_pom_text(parent, 'version')
+        properties['project.parent.version'] = get_pom_text(parent, 'version')
+
+    properties['project.groupId'] = group
+    properties['project.version'] = version
+    properties['pom.version'] = version
+    properties['version'] = version
+    for child in get_pom_children(root, 'properties'):
+        properties[child.tag.split('}')[-1]] = (child.text or '').strip()
+
+    def interpolate(value):
+        for _ in xrange(10):
+            if not value or '${' not in value:
+                break
+            value = POM_PROPERTY.sub(
+                lambda x: properties.get(x.group(1)) or x.group(0), value)
+        return value
+
+    for dependency in get_pom_children(
+            get_pom_child(root, 'dependencyManagement'), 'dependencies'):
+        module = (interpolate(get_pom_text(dependency, 'groupId')),
+                  get_pom_text(dependency, 'artifactId'))
+        managed_versions[module] = interpolate(
+            get_pom_text(dependency, 'version'))
+
+    dependencies = []
+    for dependency in get_pom_children(root, 'dependencies'):
+        dependency_group = interpolate(get_pom_text(dependency, 'groupId'))
+        dependency_id = get_pom_text(dependency, 'artifactId')
+        if (get_pom_text(dependency, 'scope') or 'compile') not in POM_SCOPES:
+            continue
+        if get_pom_text(dependency, 'optional') == 'true':
+            continue
+        dependency_version = interpolate(
+            get_pom_text(dependency, 'version') or
+            managed_versions.get((dependency_group, dependency_id)))
+        exclusions = set()
+        for exclusion in get_pom_children(dependency, 'exclusions'):
+            exclusions.add((get_pom_text(exclusion, 'groupId'),
+                            get_pom_text(exclusion, 'artifactId')))
+        dependencies.append(((dependency_group, dependency_id),
+                             dependency_version,
+                             exclusions))
+    return {
+        'properties': properties,
+        'managed_versions': managed_versions,
+        'dependencies': dependencies,
+    }
+
+
+def get_pom(group, dep_id, version, gradle_cache_index, files_root):
+    pom_file = find_pom_file(group,
+                             dep_id,
+                             version,
+                             gradle_cache_index,
+                             files_root)
+    if not pom_file:
+        return None
+    if pom_file not in POM_FILES:
+        POM_FILES[pom_file] = parse_pom_file(
+            pom_file,
+            lambda *x: get_pom(*x + (gradle_cache_index, files_root)))
+    return POM_FILES[pom_file]
+
+
+def select_version(selected_versions, module, version):
+    if (module not in selected_versions or
+            get_version_key(version) >
+            get_version_key(selected_versions[module])):
+        selected_versions[module] = version
+
+
+def resolve_transitive_dependencies(modules, gradle_cache_index, files_root):
+    """
+    Walks the poms of modules, a list of ((group, id), version), and returns
+    every module needed at compile or run time with the version gradle
+    would pick: the highest one asked for by the modules it keeps. Each
+    walk picks the versions for the next one from the declared modules and
+    the versions that the modules actually walked asked for, until they
+    stop changing, so that only the dependencies of the winning versions
+    are kept.
+    """
+    selected_versions = {}
+    for module, version in modules:
+        select_version(selected_versions, module, version)
+    seen_selections = []
+    while True:
+        requested_versions = {}
+        for module, version in modules:
+            select_version(requested_versions, module, version)
+        walked_modules = collections.OrderedDict()
+        to_walk = collections.deque(
+            (module, frozenset()) for module, _ in modules)
+        while to_walk:
+            module, exclusions = to_walk.popleft()
+            if module in walked_modules:
+                continue
+            walked_modules[module] = selected_versions.get(
+                module, requested_versions[module])
+            pom = get_pom(module[0],
+                          module[1],
+                          walked_modules[module],
+                          gradle_cache_index,
+                          files_root)
+            for dependency, version, dependency_exclusions in (
+                    pom['dependencies'] if pom else ()):
+                if (dependency in exclusions or
+                        (dependency[0], '*') in exclusions or
+                        not version or
+                        '$' in version or
+                        version[0] in '[('):
+                    continue
+                select_version(requested_versions, dependency, version)
+                to_walk.append((dependency,
+                                exclusions.union(dependency_exclusions)))
+        seen_selections.append(selected_versions)
+        selected_versions = requested_versions
+        if (selected_versions == walked_modules or
+                selected_versions in seen_selections):
+            return walked_modules
+
+
+def add_transitive_dependencies(dependencies,
+                                gradle_cache_index,
+                                files_root):
+    """
+    Adds the modules that dependencies, keyed by normalized notation, need
+    transitively. Modules that are declared directly keep their notation,
+    with the version bumped if a higher one is needed elsewhere.
+    """
+    declared_modules = []
+    for normalized_dependency in dependencies:
+        coordinate_match = MAVEN_COORDINATE.match(normalized_dependency)
+        if coordinate_match and '$' not in normalized_dependency:
+            declared_modules.append(((coordinate_match.group(1),
+                                      coordinate_match.group(2)),
+                                     coordinate_match.group(4)))
+    with profile_step('resolve_transitive_dependencies'):
+        modules = resolve_transitive_dependencies(declared_modules,
+                                                  gradle_cache_index,
+                                                  files_root)
+
+    transitive_dependencies = collections.OrderedDict()
+    for normalized_dependency, dependency in dependencies.iteritems():
+        coordinate_match = MAVEN_COORDINATE.match(normalized_dependency)
+        module = coordinate_match and (coordinate_match.group(1),
+                                       coordinate_match.group(2))
+        if module in modules:
+            normalized_dependency = '{0}:{1}'.format(
+                normalized_dependency.rsplit(':', 1)[0], modules[module])
+            dependency = normalized_dependency
+        transitive_dependencies.setdefault(normalized_dependency, dependency)
+    declared_modules = set(module for module, _ in declared_modules)
+    for module, version in modules.iteritems():
+        if module not in declared_modules:
+            dependency = '{0}:{1}:{2}'.format(module[0], module[1], version)
+            transitive_dependencies.setdefault(dependency, dependency)
+    print '\tFound {0} transitive dependencies'.format(
+        len(set(modules).difference(declared_modules)))
+    return transitive_dependencies
+
+
+def normalize_dependency(dependency):
+    """
+    Turns group:id:version@type into the group:id:type:version form that
+    MAVEN_COORDINATE expects.
+    """
+    if '@' not in dependency:
+        return dependency
+    dependency, dep_type = dependency.rsplit('@', 1)
+    parts = dependency.split(':')
+    if len(parts) == 3:
+        parts.insert(2, dep_type)
+    return ':'.join(parts)
+
+
+def get_local_maven_repository(group):
+    if group.startswith('com.google.android'):
+        return path.join(path.expandvars('$ANDROID_HOME'),
+                         'extras/google/m2repository/')
+    elif group.startswith('com.android'):
+        return path.join(path.expandvars('$ANDROID_HOME'),
+                         'extras/android/m2repository/')
+    return None
+
+
+def get_local_maven_path(local_maven_repository, group, dep_id, version):
+    return path.join(local_maven_repository,
+                     group.replace('.', '/'),
+                     dep_id,
+                     version)
+
+
+def get_file_sha1(file_path):
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as file_contents:
+        for chunk in iter(lambda: file_contents.read(1 << 16), ''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def find_m2repository_artifact(maven_path, dep_id, version):
+    """
+    Returns the type and sha1 of the first of POSSIBLE_MAVEN_TYPES found in
+    an m2repository version directory, hashing the artifact itself when it
+    has no .sha1 file next to it.
+    """
+    for possible_type in POSSIBLE_MAVEN_TYPES:
+        artifact = path.join(maven_path, '{dep_id}-{version}.{type}'.format(
+            dep_id=dep_id,
+            version=version,
+            type=possible_type[0],
+        ))
+        if path.exists(artifact + '.sha1'):
+            with open(artifact + '.sha1', 'r') as maven_sha_file:
+                return possible_type[0], maven_sha_file.read().split()[0]
+        if path.exists(artifact):
+            return possible_type[0], get_file_sha1(artifact)
+    return None, None
+
+
+def get_m2repository_artifact(maven_path, dep_id, version, m2repository_index):
+    """
+    Looks an artifact up in m2repository_index, which is keyed by version
+    directory and only trusted while the directory's mtime is unchanged.
+    Returns the type, the sha1 and the index entry to store, if any.
+    """
+    if not path.isdir(maven_path):
+        return None, None, None
+    mtime = os.stat(maven_path).st_mtime
+    entry = m2repository_index.get(maven_path)
+    if entry and entry['mtime'] == mtime:
+        return entry['type'], entry['hash'], None
+    dep_type, dep_hash = find_m2repository_artifact(maven_path,
+                                                    dep_id,
+                                                    version)
+    if not dep_hash:
+        return None, None, None
+    return dep_type, dep_hash, {maven_path: {
+        'mtime': mtime,
+        'type': dep_type,
+        'hash': dep_hash,
+    }}
+
+
+def get_maven_coordinate(dependency, gradle_cache_index, m2repository_index):
+    """
+    Resolves one dependency notation to the fields of its remote_file rule.
+    Returns them, a new m2repository_index entry and an error message, any
+    of which may be None, so that it can run on a thread pool.
+    """
+    coordinate_match = MAVEN_COORDINATE.match(normalize_dependency(dependency))
+    if not coordinate_match or '$' in dependency:
+        return None, None, "Couldn't parse maven coordiante {0}".format(
+            dependency)
+    prebuilt_type = 'prebuilt_jar'
+    binary_field = 'binary_jar'
+    group = coordinate_match.group(1)
+    dep_id = coordinate_match.group(2)
+    repo = 'mvn'
+    local_maven_repository = None
+    m2repository_entry = None
+
+    if coordinate_match.group(3):
+        dep_type = coordinate_match.group(3).rstrip(':')
+    else:
+        local_maven_repository = get_local_maven_repository(group)
+        if not local_maven_repository:
+            dep_type = 'jar'
+
+    version = coordinate_match.group(4)
+
+    dep_hash = None
+    if local_maven_repository:
+        maven_path = get_local_maven_path(local_maven_repository,
+                                          group,
+                                          dep_id,
+                                          version)
+        dep_type, dep_hash, m2repository_entry = get_m2repository_artifact(
+            maven_path,
+            dep_id,
+            version,
+            m2repository_index)
+        for possible_type in POSSIBLE_MAVEN_TYPES:
+            if possible_type[0] == dep_type:
+                prebuilt_type = possible_type[1]
+                binary_field = possible_type[2]
+    else:
+        for possible_type in POSSIBLE_MAVEN_TYPES:
+            dep_hash = gradle_cache_index.get(
+                get_gradle_cache_key(group,
+                                     dep_id,
+                                     version,
+                                     possible_type[0]))
+            if dep_hash:
+                dep_type = possible_type[0]
+                prebuilt_type = possible_type[1]
+                binary_field = possible_type[2]
+                break
+    if not dep_hash:
+        return None, None, "\tCoudn't find a hash for {0}".format(
+            coordinate_match.group(0))
+
+    if len(dep_hash) % 2 != 0:
+        dep_hash = '0' + dep_hash
+    coordinate = "{group}:{id}:{type}:{version}".format(
+        group=group,
+        id=dep_id,
+        type=dep_type,
+        version=version,
+    )
+    return {
+        'name': dep_id,
+        'repo': repo,
+        'prebuilt_type': prebuilt_type,
+        'binary_field': binary_field,
+        'coordinate': coordinate,
+        'hash': dep_hash
+    }, m2repository_entry, None
+
+
+def get_maven_type(dep_type):
+    for possible_type in POSSIBLE_MAVEN_TYPES:
+        if possible_type[0] == dep_type:
+            return possible_type
+    return dep_type, 'prebuilt_jar', 'binary_jar'
+
+
+def get_artifact_index_directory(artifact_index, coordinate):
+    coordinate_match = MAVEN_COORDINATE.match(coordinate)
+    return path.join(artifact_index,
+                     coordinate_match.group(1),
+                     coordinate_match.group(2),
+                     coordinate_match.group(4))
+
+
+def read_artifact_index_entry(artifact_index, coordinate, dep_hash):
+    """
+    Returns what artifact_index holds for the artifact with this maven
+    coordinate and sha1, or None. Entries never change once written, so
+    the index can be shared read-only between checkouts and CI workers.
+    """
+    entry = read_cache_file(
+        get_artifact_index_directory(artifact_index, coordinate),
+        ARTIFACT_INDEX_ENTRY.format(dep_hash))
+    if not entry or entry.get('coordinate') != coordinate:
+        return None
+    return entry
+
+
+def update_artifact_index_entry(artifact_index,
+                                coordinate,
+                                dep_hash,
+                                classes=None):
+    """
+    Adds an artifact to artifact_index, along with its classes if they are
+    known. Existing entries are only rewritten to add missing classes.
+    """
+    entry = read_artifact_index_entry(artifact_index, coordinate, dep_hash)
+    if entry and (classes is None or entry.get('classes') is not None):
+        return
+    if not entry:
+        dep_type, prebuilt_type, binary_field = get_maven_type(
+            MAVEN_COORDINATE.match(coordinate).group(3).rstrip(':'))
+        entry = {
+            'coordinate': coordinate,
+            'hash': dep_hash,
+            'type': dep_type,
+            'prebuilt_type': prebuilt_type,
+            'binary_field': binary_field,
+        }
+    if classes is not None:
+        entry['classes'] = sorted(classes)
+    write_cache_file(get_artifact_index_directory(artifact_index, coordinate),
+                     ARTIFACT_INDEX_ENTRY.format(dep_hash),
+                     entry)
+
+
+def get_indexed_maven_coordinate(artifact_index, dependency):
+    """
+    Resolves a dependency from artifact_index alone, choosing between the
+    types recorded for its version the same way get_maven_coordinate does.
+    """
+    coordinate_match = MAVEN_COORDINATE.match(normalize_dependency(dependency))
+    if not coordinate_match or '$' in dependency:
+        return None
+    group = coordinate_match.group(1)
+    dep_id = coordinate_match.group(2)
+    version = coordinate_match.group(4)
+    directory = path.join(artifact_index, group, dep_id, version)
+    if not path.isdir(directory):
+        return None
+    entries = {}
+    for entry_file in sorted(os.listdir(directory)):
+        entry = read_cache_file(directory, entry_file)
+        if entry and 'type' in entry:
+            entries.setdefault(entry['type'], entry)
+    if coordinate_match.group(3):
+        entry = entries.get(coordinate_match.group(3).rstrip(':'))
+    else:
+        entry = next((entries[x[0]] for x in POSSIBLE_MAVEN_TYPES
+                      if x[0] in entries), None)
+    if not entry:
+        return None
+    return {
+        'name': dep_id,
+        'repo': 'mvn',
+        'prebuilt_type': entry['prebuilt_type'],
+        'binary_field': entry['binary_field'],
+        'coordinate': entry['coordinate'],
+        'hash': entry['hash']
+    }
+
+
+def get_remote_artifact(target):
+    """
+    Returns the maven coordinate and sha1 of the remote_file a prebuilt
+    target's binary comes from, if it is declared next to it.
+    """
+    rule = get_buck_rule(target)
+    if not rule:
+        return None
+    binary = (rule['attributes'].get('binary_jar') or
+              rule['attributes'].get('aar') or '')
+    if not binary.startswith(':'):
+        return None
+    remote_file = get_buck_rule(target.split(':')[0] + binary)
+    if not remote_file or remote_file['type'] != 'remote_file':
+        return None
+    url = remote_file['attributes'].get('url', '')
+    dep_hash = remote_file['attributes'].get('sha1')
+    if ':' not in url or not dep_hash:
+        return None
+    coordinate = url.split(':', 1)[1]
+    if not MAVEN_COORDINATE.match(coordinate):
+        return None
+    return coordinate, dep_hash
+
+
+def get_artifact_index_classes(artifact_index, target):
+    remote_artifact = get_remote_artifact(target)
+    if not remote_artifact:
+        return None
+    entry = read_artifact_index_entry(artifact_index, *remote_artifact)
+    if not entry or entry.get('classes') is None:
+        return None
+    count_profile_event('artifact_index_hits')
+    return entry['classes']
+
+
+def export_artifact_classes(artifact_index, target, classes):
+    remote_artifact = get_remote_artifact(target)
+    if remote_artifact:
+        update_artifact_index_entry(artifact_index,
+                                    remote_artifact[0],
+                                    remote_artifact[1],
+                                    classes)
+
+
+def write_remote_deps(third_party_buck_file, maven_coordinates, plan=None):
+    existing_deps = get_existing_third_party_jars()
+    buck_file = []
+    if path.exists(third_party_buck_file):
+        with open(third_party_buck_file, 'r') as buck_file_contents:
+            buck_file.append(buck_file_contents.read())
+    unchanged = bool(buck_file)
+    for maven_coordinate in maven_coordinates.values():
+        if maven_coordinate['name'] not in existing_deps:
+            buck_file.append(REMOTE_DEP_TEMPLATE.format(**maven_coordinate))
+            unchanged = False
+    if unchanged:
+        return
+    if plan is None:
+        write_file_atomically(third_party_buck_file, ''.join(buck_file))
+    else:
+        plan.files[third_party_buck_file] = ''.join(buck_file)
+
+
+def get_classes_for_zip(zip_file):
     classes = []
-    for line in jar_output.splitlines():
-        match = CLASS_FILE.search(line)
+    for name in zip_file.namelist():
+        match = CLASS_FILE.match(name)
         if match:
             classes.append(match.group(1).replace('/', '.').replace('$', '.'))
     return classes
 
 
+def get_classes_for_aar(aar):
+    with zipfile.ZipFile(aar) as aar_file:
+        try:
+            classes_jar = io.BytesIO(aar_file.read('classes.jar'))
+        except KeyError:
+            return []
+    with zipfile.ZipFile(classes_jar) as jar_file:
+        return get_classes_for_zip(jar_file)
+
+
+def get_classes_for_jar(jar):
+    with zipfile.ZipFile(jar) as jar_file:
+        return get_classes_for_zip(jar_file)
+
+
+def configure_buck_session(executable='buck', max_parallel_calls=1):
+    BUCK_SESSION['executable'] = executable
+    BUCK_SESSION['semaphore'] = threading.BoundedSemaphore(
+        max(max_parallel_calls, 1))
+    BUCK_SESSION['warm'] = False
+    BUCK_SESSION['calls'] = []
+
+
+def warm_up_buck():
+    """
+    Makes sure buckd is running before the first real call, so that every
+    call after it reuses the daemon's warm JVM and parsed build files.
+    """
+    with BUCK_SESSION['warm_up_lock']:
+        if BUCK_SESSION['warm']:
+            return
+        BUCK_SESSION['warm'] = True
+        if os.environ.get('NO_BUCKD'):
+            print '\tNO_BUCKD is set, every buck call will start a new JVM'
+        elif not path.isdir('.buckd'):
+            call_buck(['server', 'status'])
+
+
+def run_buck(buck_args, check=False):
+    """
+    Runs a buck command through the shared session and returns its exit
+    code, stdout and stderr. At most max_parallel_calls commands run at
+    once, since buckd serves a single command at a time, and every call is
+    timed in BUCK_SESSION['calls'].
+    """
+    warm_up_buck()
+    return call_buck(buck_args, check)
+
+
+def call_buck(buck_args, check=False):
+    command = [BUCK_SESSION['executable']] + buck_args
+    with BUCK_SESSION['semaphore']:
+        count_profile_event('subprocess_spawns')
+        with profile_step('buck ' + buck_args[0]):
+            start = time.time()
+            process = subprocess.Popen(command,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+            out, err = process.communicate()
+            elapsed = time.time() - start
+    BUCK_SESSION['calls'].append((buck_args[0], elapsed, process.returncode))
+    if check and process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode,
+                                            ' '.join(command),
+                                            err)
+    return process.returncode, out, err
+
+
+def buck_check_output(buck_args):
+    return run_buck(buck_args, check=True)[1]
+
+
+def print_buck_session_summary():
+    calls = BUCK_SESSION['calls']
+    print '\t*** {0} buck calls took {1:.1f}s'.format(
+        len(calls),
+        sum(x[1] for x in calls))
+    for command in sorted(set(x[0] for x in calls)):
+        command_calls = [x for x in calls if x[0] == command]
+        print '\t    buck {0}: {1} calls, {2:.1f}s'.format(
+            command,
+            len(command_calls),
+            sum(x[1] for x in command_calls))
+
+
 def get_existing_third_party_jars():
-    all_jar_targets = subprocess.check_output(['buck',
-                                               'targets',
-                                               '--type',
-                                               'prebuilt_jar',
-                                               'android_prebuilt_aar'],
-                                              stderr=FNULL)
+    if not path.exists('.buckconfig'):
+        return set()
+    all_jar_targets = buck_check_output(['targets',
+                                         '--type',
+                                         'prebuilt_jar',
+                                         'android_prebuilt_aar'])
     result = set()
     for jar_target in all_jar_targets.splitlines():
         result.add(jar_target.rstrip().split(':')[1])
     return result
 
 
-def create_third_party_map():
-    third_party_map = {}
+def get_buck_file_for_target(target):
+    return path.join(get_target_directory(target), 'BUCK')
+
+
+def get_artifact_stamp(artifact):
+    if not path.exists(artifact):
+        return None
+    stat = os.stat(artifact)
+    return stat.st_mtime, stat.st_size
+
+
+def open_class_index(cache_dir):
+    class_index_path = path.join(cache_dir, CLASS_INDEX)
+    if CACHE_SESSION['read_only']:
+        if not path.exists(class_index_path):
+            class_index_path = ':memory:'
+    elif not path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    class_index = sqlite3.connect(class_index_path)
+    if (class_index.execute('PRAGMA user_version').fetchone()[0] !=
+            CLASS_INDEX_VERSION):
+        if CACHE_SESSION['read_only']:
+            class_index.close()
+            class_index = sqlite3.connect(':memory:')
+        else:
+            with class_index:
+                class_index.execute('DROP TABLE IF EXISTS artifacts')
+                class_index.execute('DROP TABLE IF EXISTS classes')
+            class_index.execute('PRAGMA user_version = {0}'.format(
+                CLASS_INDEX_VERSION))
+    class_index.execute('CREATE TABLE IF NOT EXISTS artifacts ('
+                        'target TEXT PRIMARY KEY, '
+                        'source TEXT, '
+                        'artifact TEXT, '
+                        'artifact_mtime REAL, '
+                        'artifact_size INTEGER)')
+    class_index.execute('CREATE TABLE IF NOT EXISTS classes ('
+                        'target TEXT, '
+                        'class_name TEXT)')
+    class_index.execute('CREATE INDEX IF NOT EXISTS classes_by_target '
+                        'ON classes (target)')
+    return class_index
+
+
+def get_prebuilt_source(target):
+    """
+    Returns what a prebuilt's binary comes from: the sha1 of its
+    remote_file, or the path, mtime and size of its file in the repo.
+    """
+    remote_artifact = get_remote_artifact(target)
+    if remote_artifact:
+        return remote_artifact[1]
+    rule = get_buck_rule(target)
+    binary = rule and (rule['attributes'].get('binary_jar') or
+                       rule['attributes'].get('aar'))
+    if not binary or binary.startswith(':') or binary.startswith('//'):
+        return None
+    binary_path = path.join(get_target_directory(target), binary)
+    stamp = get_artifact_stamp(binary_path)
+    return stamp and '{0}:{1}:{2}'.format(binary_path, *stamp)
+
+
+def get_indexed_classes(class_index, target, artifact=None):
+    """
+    Returns the classes recorded for target, or None if the binary it is
+    built from or the artifact it produced changed since they were indexed.
+    """
+    row = class_index.execute('SELECT source, artifact, '
+                              'artifact_mtime, artifact_size '
+                              'FROM artifacts WHERE target = ?',
+                              (target,)).fetchone()
+    if not row:
+        return None
+    source, indexed_artifact, artifact_mtime, artifact_size = row
+    if source != get_prebuilt_source(target):
+        return None
+    if artifact and artifact != indexed_artifact:
+        return None
+    if get_artifact_stamp(indexed_artifact) != (artifact_mtime,
+                                                artifact_size):
+        return None
+    return [x[0] for x in class_index.execute(
+        'SELECT class_name FROM classes WHERE target = ?', (target,))]
+
+
+def index_classes(class_index, target, artifact, classes):
+    if CACHE_SESSION['read_only']:
+        return
+    artifact_mtime, artifact_size = get_artifact_stamp(artifact)
+    with class_index:
+        class_index.execute('DELETE FROM classes WHERE target = ?', (target,))
+        class_index.execute('INSERT OR REPLACE INTO artifacts '
+                            'VALUES (?, ?, ?, ?, ?)',
+                            (target,
+                             get_prebuilt_source(target),
+                             artifact,
+                             artifact_mtime,
+                             artifact_size))
+        class_index.executemany('INSERT INTO classes VALUES (?, ?)',
+                                ((target, x) for x in classes))
+
+
+def get_classes_for_target(class_index,
+                           target,
+                           get_classes,
+                           artifact_index=None,
+                           export_artifact_index=False):
+    classes = get_indexed_classes(class_index, target)
+    if classes is None and artifact_index:
+        classes = get_artifact_index_classes(artifact_index, target)
+
+    if classes is None:
+        run_buck(['build', target], check=True)
+        location = get_target_outputs([target])[target]
+        classes = get_indexed_classes(class_index, target, location)
+        if classes is None:
+            classes = get_classes(location)
+            index_classes(class_index, target, location, classes)
+    if artifact_index and export_artifact_index:
+        export_artifact_classes(artifact_index, target, classes)
+    return classes
+
+
+def get_target_outputs(targets):
+    outputs = {}
+    if not targets:
+        return outputs
+    show_output = buck_check_output(['targets', '--show_output'] + targets)
+    for line in show_output.splitlines():
+        parts = line.split(' ', 1)
+        if len(parts) == 2:
+            outputs[parts[0]] = parts[1].strip()
+    return outputs
+
+
+def create_third_party_map_batched(cache_dir,
+                                   artifact_index=None,
+                                   export_artifact_index=False):
+    """
+    Same as create_third_party_map, but queries every third party rule type
+    with one 'buck targets --json' call and builds every prebuilt that is
+    missing from the class index and artifact index with one 'buck build'
+    call.
+    """
+    third_party_packages = {}
     android_libraries = set()
-    all_jar_targets = subprocess.check_output(['buck',
-                                               'targets',
-                                               '--type',
-                                               'prebuilt_jar'],
-                                              stderr=FNULL)
+    class_readers = {
+        'prebuilt_jar': get_classes_for_jar,
+        'android_prebuilt_aar': get_classes_for_aar,
+    }
+    class_index = open_class_index(cache_dir)
+    rules = json.loads(buck_check_output(['targets',
+                                          '--json',
+                                          '--type'] +
+                                         THIRD_PARTY_RULE_TYPES))
+    rules.sort(key=lambda x: THIRD_PARTY_RULE_TYPES.index(x['buck.type']))
+
+    prebuilt_classes = {}
+    targets_to_build = []
+    for rule in rules:
+        target = '//{0}:{1}'.format(rule['buck.base_path'], rule['name'])
+        if rule['buck.type'] in class_readers:
+            prebuilt_classes[target] = get_indexed_classes(class_index, target)
+            if prebuilt_classes[target] is None and artifact_index:
+                prebuilt_classes[target] = get_artifact_index_classes(
+                    artifact_index, target)
+            if prebuilt_classes[target] is None:
+                targets_to_build.append(target)
+
+    if targets_to_build:
+        run_buck(['build'] + targets_to_build, check=True)
+    outputs = get_target_outputs(targets_to_build)
+
+    for rule in rules:
+        target = '//{0}:{1}'.format(rule['buck.base_path'], rule['name'])
+        rule_type = rule['buck.type']
+        if rule_type in class_readers:
+            classes = prebuilt_classes[target]
+            if classes is None:
+                location = outputs[target]
+                classes = get_indexed_classes(class_index, target, location)
+                if classes is None:
+                    classes = class_readers[rule_type](location)
+                    index_classes(class_index, target, location, classes)
+            if artifact_index and export_artifact_index:
+                export_artifact_classes(artifact_index, target, classes)
+            add_classes_to_index(third_party_packages, target, classes)
+        elif 'package' in rule:
+            add_classes_to_index(
+                third_party_packages,
+                target,
+                [rule['package'] + PACKAGE_CLASS_SUFFIXES[rule_type]])
+        if rule_type != 'prebuilt_jar':
+            android_libraries.add(target)
+    class_index.close()
+
+    return create_class_index(third_party_packages), android_libraries
+
+
+def create_third_party_map(cache_dir,
+                           artifact_index=None,
+                           export_artifact_index=False):
+    third_party_packages = {}
+    android_libraries = set()
+    class_index = open_class_index(cache_dir)
+    all_jar_targets = buck_check_output(['targets',
+                                         '--type',
+                                         'prebuilt_jar'])
     for jar_target in all_jar_targets.splitlines():
-        subprocess.check_call(['buck',
-                               'build',
-                               jar_target],
-                              stderr=FNULL)
-        jar_location = subprocess.check_output(['buck',
-                                                'targets',
-                                                '--show_output',
-                                                jar_target],
-                                               stderr=FNULL).split(' ')[1]
-        jar_location = jar_location.strip()
-        for java_class in get_classes_for_jar(jar_location):
-            third_party_map[java_class] = jar_target
-
-    all_aar_targets = subprocess.check_output(['buck',
-                                               'targets',
-                                               '--type',
-                                               'android_prebuilt_aar'],
-                                              stderr=FNULL)
+        add_classes_to_index(third_party_packages,
+                             jar_target,
+                             get_classes_for_target(class_index,
+                                                    jar_target,
+                                                    get_classes_for_jar,
+                                                    artifact_index,
+                                                    export_artifact_index))
+
+    all_aar_targets = buck_check_output(['targets',
+                                         '--type',
+                                         'android_prebuilt_aar'])
     for aar_target in all_aar_targets.splitlines():
-        subprocess.check_call(['buck',
-                               'build',
-                               aar_target],
-                              stderr=FNULL)
-        aar_location = subprocess.check_output(['buck',
-                                                'targets',
-                                                '--show_output',
-                                                aar_target],
-                                               stderr=FNULL).split(' ')[1]
-        aar_location = aar_location.strip()
-        for java_class in get_classes_for_aar(aar_location):
-            third_party_map[java_class] = aar_target
+        add_classes_to_index(third_party_packages,
+                             aar_target,
+                             get_classes_for_target(class_index,
+                                                    aar_target,
+                                                    get_classes_for_aar,
+                                                    artifact_index,
+                                                    export_artifact_index))
         android_libraries.add(aar_target)
+    class_index.close()
 
-    build_config_targets = subprocess.check_output(['buck',
-                                                    'targets',
-                                                    '--type',
-                                                    'android_build_config'],
-                                                   stderr=FNULL)
+    build_config_targets = buck_check_output(['targets',
+                                              '--type',
+                                              'android_build_config'])
     for build_config_target in build_config_targets.splitlines():
-        buck_file = build_config_target.split(':')[0].lstrip('/') + '/BUCK'
+        buck_file = get_buck_file_for_target(build_config_target)
         with open(buck_file, 'r') as buck_file_contents:
             for line in buck_file_contents.readlines():
                 line = line.rstrip()
                 match = PACKAGE_DECLARATION.match(line)
                 if match:
-                    third_party_map[match.group(1) + '.BuildConfig'] = \
-                        build_config_target
+                    add_classes_to_index(third_party_packages,
+                                         build_config_target,
+                                         [match.group(1) + '.BuildConfig'])
         android_libraries.add(build_config_target)
 
-    android_resouce_targets = subprocess.check_output(['buck',
-                                                       'targets',
-                                                       '--type',
-                                                       'android_resource'],
-                                                      stderr=FNULL)
+    android_resouce_targets = buck_check_output(['targets',
+                                                 '--type',
+                                                 'android_resource'])
 
     for android_resouce_target in android_resouce_targets.splitlines():
-        buck_file = android_resouce_target.split(':')[0].lstrip('/') + '/BUCK'
+        buck_file = get_buck_file_for_target(android_resouce_target)
         with open(buck_file, 'r') as buck_file_contents:
             for line in buck_file_contents.readlines():
                 line = line.rstrip()
                 match = PACKAGE_DECLARATION.match(line)
                 if match:
-                    third_party_map[match.group(1) + '.R'] = \
-                        android_resouce_target
+                    add_classes_to_index(third_party_packages,
+                                         android_resouce_target,
+                                         [match.group(1) + '.R'])
         android_libraries.add(android_resouce_target)
 
-    return third_party_map, android_libraries
+    return create_class_index(third_party_packages), android_libraries
 
 
-def find_missing_deps_from_output(buck_rule, output):
+def find_missing_deps_by_rule(output, default_rule=None):
+    """
+    Maps each rule that buck reported missing deps for to those deps. Blocks
+    that can't be tied to a failing rule are attributed to default_rule.
+    """
     in_try_adding = False
     in_missing_deps = False
-    missing_deps = set()
+    current_rule = default_rule
+    missing_deps = {}
     for line in (x.strip() for x in output.splitlines()):
         if line == 'Try adding the following deps:':
             in_try_adding = True
@@ -549,156 +2781,452 @@ def find_missing_deps_from_output(buck_rule, output):
             if not line:
                 in_try_adding = False
             else:
-                missing_deps.add(line)
+                missing_deps.setdefault(current_rule, set()).add(line)
         elif line.endswith(' is missing deps:'):
             in_missing_deps = True
-        elif in_missing_deps:
-            match = DEP_DECLARATION.match(line)
-            if match:
-                missing_deps.add(match.group(1))
-            else:
-                in_missing_deps = False
+            current_rule = line[:-len(' is missing deps:')]
+        elif in_missing_deps and DEP_DECLARATION.match(line):
+            missing_deps.setdefault(current_rule, set()).add(
+                DEP_DECLARATION.match(line).group(1))
+        else:
+            in_missing_deps = False
+            failed_rule_match = FAILED_RULE.search(line)
+            if failed_rule_match:
+                current_rule = failed_rule_match.group(1)
+    return {rule: {dep for dep in deps if dep != rule}
+            for rule, deps in missing_deps.iteritems()}
+
+
+def find_missing_deps_from_output(buck_rule, output):
+    missing_deps = set()
+    for deps in find_missing_deps_by_rule(output, buck_rule).values():
+        missing_deps.update(deps)
     return {dep for dep in missing_deps if dep != buck_rule}
 
 
-def add_missing_deps(buck_rules, android_libraries):
-    settled = False
+def add_missing_deps(buck_rules, android_libraries, batch_size=None, jobs=1):
+    """
+    Repeatedly builds rules and adds the deps buck asks for until no BUCK
+    file changes. After the first pass only the rules declared in a changed
+    BUCK file, and the rules that depend on them, are rebuilt. Returns
+    whether each rule compiled the last time it was built.
+    """
+    build_results = {}
+    worklist = buck_rules
     pass_count = 1
-    while not settled:
-        print '\t*** Adding Deps: Pass {0}'.format(pass_count)
-        files_changed = add_missing_deps_pass(buck_rules, android_libraries)
-        print '\t*** Modified {0} BUCK files'.format(files_changed)
-        settled = files_changed == 0
+    while worklist:
+        print '\t*** Adding Deps: Pass {0} ({1} rules)'.format(pass_count,
+                                                             len(worklist))
+        with profile_step('missing_deps_pass_{0}'.format(pass_count)):
+            if batch_size:
+                modified_files = add_missing_deps_pass_batched(
+                    worklist,
+                    android_libraries,
+                    batch_size,
+                    jobs,
+                    build_results)
+            else:
+                modified_files = add_missing_deps_pass(worklist,
+                                                       android_libraries,
+                                                       build_results)
+        print '\t*** Modified {0} BUCK files'.format(len(modified_files))
+        worklist = get_rules_affected_by(buck_rules, modified_files)
         pass_count += 1
+    return build_results
 
 
-def modify_buck_rule(buck_rule, new_deps_fn=None, new_rule_type=None):
-    existing_deps = set()
-    buck_file_with_new_deps = []
-    found_deps_open = False
-    found_deps_close = False
-    found_rule_name = False
-    buck_file = path.join(buck_rule.lstrip('/').split(':')[0], 'BUCK')
-    rule_name = buck_rule.split(':')[1]
-    modified_file = False
+def get_deps_for_rule(buck_rule):
+    rule = get_buck_rule(buck_rule)
+    if rule is None or rule['deps'] is None:
+        return set()
+    return set(rule['deps'])
+
+
+def get_rules_affected_by(buck_rules, modified_files):
+    """
+    Returns the rules declared in modified_files along with every rule that
+    transitively depends on one of them, in buck_rules order.
+    """
+    if not modified_files:
+        return []
+    reverse_deps = {}
+    for rule in buck_rules:
+        for dep in get_deps_for_rule(rule):
+            reverse_deps.setdefault(dep, set()).add(rule)
+
+    affected = set()
+    to_visit = [rule for rule in buck_rules
+                if get_buck_file_for_target(rule) in modified_files]
+    while to_visit:
+        rule = to_visit.pop()
+        if rule not in affected:
+            affected.add(rule)
+            to_visit.extend(reverse_deps.get(rule, ()))
+    return [rule for rule in buck_rules if rule in affected]
+
+
+def parse_buck_file(buck_file):
+    """
+    Splits a BUCK file into verbatim lines, rule type lines and deps blocks,
+    so that rule types and deps can be edited without touching anything
+    else in the file.
+    """
+    parts = []
+    rules = {}
+    rule = None
+    in_deps = None
     with open(buck_file, 'r') as buck_file_contents:
-        for line in buck_file_contents.readlines():
-            line = line.rstrip()
-            name_match = NAME_DECLARATION.match(line)
-            if name_match and name_match.group(1) == rule_name:
-                found_rule_name = True
-                if (new_rule_type and
-                        not buck_file_with_new_deps[-1].startswith(
-                            new_rule_type)):
-                    buck_file_with_new_deps[-1] = '{0}('.format(new_rule_type)
-                    modified_file = True
-                buck_file_with_new_deps.append(line)
-            elif (found_rule_name and
-                      DEPS_START.match(line) and
-                      not found_deps_close):
-                found_deps_open = True
-            elif found_deps_open and not found_deps_close:
-                if line.endswith('],'):
-                    buck_file_with_new_deps.append('  deps = [')
-                    new_deps = new_deps_fn(existing_deps)
-                    buck_file_with_new_deps.extend(
-                        format_deps_for_buck_file(new_deps))
-                    buck_file_with_new_deps.append('  ],')
-                    if new_deps != existing_deps:
-                        modified_file = True
-                    found_deps_close = True
-                else:
-                    match = DEP_DECLARATION.match(line)
-                    if match:
-                        existing_deps.add(match.group(1))
+        contents = buck_file_contents.read()
+    for line in contents.splitlines():
+        line = line.rstrip()
+        rule_start_match = RULE_START.match(line)
+        name_match = NAME_DECLARATION.match(line)
+        if in_deps:
+            if line.endswith('],'):
+                in_deps = None
             else:
-                buck_file_with_new_deps.append(line)
+                dep_match = DEP_DECLARATION.match(line)
+                if dep_match:
+                    rule[in_deps].add(dep_match.group(1))
+        elif rule_start_match:
+            rule = {'type': rule_start_match.group(1),
+                    'deps': None,
+                    'exported_deps': None,
+                    'attributes': {}}
+            parts.append(('rule', rule))
+        elif rule is not None and name_match and 'name' not in rule:
+            rule['name'] = name_match.group(1)
+            rules.setdefault(rule['name'], rule)
+            parts.append(('line', line))
+        elif (rule is not None and
+                DEPS_START.match(line) and
+                rule['deps'] is None):
+            rule['deps'] = set()
+            in_deps = 'deps'
+            parts.append(('deps', rule))
+        elif (rule is not None and
+                EXPORTED_DEPS_START.match(line) and
+                rule['exported_deps'] is None):
+            rule['exported_deps'] = set()
+            in_deps = 'exported_deps'
+            parts.append(('exported_deps', rule))
+        else:
+            attribute_match = STRING_ATTRIBUTE.match(line)
+            if rule is not None and attribute_match:
+                rule['attributes'][attribute_match.group(1)] = \
+                    attribute_match.group(2)
+            if line == ')':
+                rule = None
+            parts.append(('line', line))
+    return {
+        'path': buck_file,
+        'mtime': os.stat(buck_file).st_mtime,
+        'parts': parts,
+        'rules': rules,
+        'trailing_newline': contents.endswith('\n'),
+        'dirty': False,
+    }
+
+
+def format_buck_file(buck_file):
+    lines = []
+    for part_type, part in buck_file['parts']:
+        if part_type == 'rule':
+            lines.append('{0}('.format(part['type']))
+        elif part_type in ('deps', 'exported_deps'):
+            lines.append('  {0} = ['.format(part_type))
+            lines.extend(format_deps_for_buck_file(part[part_type]))
+            lines.append('  ],')
+        else:
+            lines.append(part)
+    contents = '\n'.join(lines)
+    if buck_file['trailing_newline']:
+        contents += '\n'
+    return contents
+
+
+def get_buck_file(buck_file):
+    """
+    Returns the parsed model of a BUCK file, loading it at most once until
+    it changes on disk. Edits stay in memory until flush_buck_files.
+    """
+    model = BUCK_FILES.get(buck_file)
+    if model is None or (not model['dirty'] and
+                         os.stat(buck_file).st_mtime != model['mtime']):
+        model = parse_buck_file(buck_file)
+        BUCK_FILES[buck_file] = model
+    return model
+
+
+def get_buck_rule(buck_rule):
+    buck_file = get_buck_file_for_target(buck_rule)
+    if not path.exists(buck_file):
+        return None
+    return get_buck_file(buck_file)['rules'].get(buck_rule.split(':')[1])
+
+
+def flush_buck_files():
+    """
+    Writes every BUCK file with in-memory edits and returns their paths.
+    """
+    flushed_files = set()
+    for buck_file, model in BUCK_FILES.iteritems():
+        if model['dirty']:
+            write_file_atomically(buck_file, format_buck_file(model))
+            model['mtime'] = os.stat(buck_file).st_mtime
+            model['dirty'] = False
+            flushed_files.add(buck_file)
+    return flushed_files
+
+
+def modify_buck_rule(buck_rule,
+                     new_deps_fn=None,
+                     new_rule_type=None,
+                     new_exported_deps_fn=None):
+    rule = get_buck_rule(buck_rule)
+    if rule is None:
+        return False
+    buck_file = get_buck_file(get_buck_file_for_target(buck_rule))
+    modified_file = False
+    if new_rule_type and rule['type'] != new_rule_type:
+        rule['type'] = new_rule_type
+        modified_file = True
+    if new_deps_fn and rule['deps'] is not None:
+        new_deps = set(new_deps_fn(set(rule['deps'])))
+        if new_deps != rule['deps']:
+            rule['deps'] = new_deps
+            modified_file = True
+    new_exported_deps = None
+    if new_exported_deps_fn and rule['deps'] is not None:
+        new_exported_deps = set(new_exported_deps_fn(
+            set(rule['exported_deps'] or ())))
+    if (new_exported_deps is not None and
+            new_exported_deps != (rule['exported_deps'] or set())):
+        if rule['exported_deps'] is None:
+            parts = buck_file['parts']
+            deps_index = next(i for i, (part_type, part) in enumerate(parts)
+                              if part_type == 'deps' and part is rule)
+            parts.insert(deps_index + 1, ('exported_deps', rule))
+        rule['exported_deps'] = new_exported_deps
+        modified_file = True
     if modified_file:
-        import pdb;
-        pdb.set_trace()
-        with open(buck_file, 'w') as buck_file_contents:
-            buck_file_contents.write(
-                '\n'.join(buck_file_with_new_deps))
+        buck_file['dirty'] = True
 
     return modified_file
 
 
-def add_missing_deps_pass(buck_rules, android_libraries):
-    files_changed = 0
-    for rule in buck_rules:
-        buck = subprocess.Popen(['buck', 'build', rule],
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        _, err = buck.communicate()
-        if buck.returncode != 0:
-            missing_deps = find_missing_deps_from_output(rule, err)
-            new_rule_type = None
-            if rule in android_libraries:
-                new_rule_type = 'android_library'
-            existing_deps = set()
-
-            def update_deps(x):
-                existing_deps.update(x)
-                return x.union(missing_deps)
-
-            if modify_buck_rule(rule,
-                                new_deps_fn=update_deps,
-                                new_rule_type=new_rule_type):
-                files_changed += 1
-            for dep in missing_deps.union(existing_deps):
-                if dep in android_libraries:
-                    android_libraries.add(rule)
-
-    return files_changed
-
-
-def get_files_for_rule(buck_rule):
+def add_deps_to_failed_rule(rule, missing_deps, android_libraries):
+    new_rule_type = None
+    if rule in android_libraries:
+        new_rule_type = 'android_library'
     existing_deps = set()
 
-    def empty_deps(x):
+    def update_deps(x):
         existing_deps.update(x)
-        return set()
-
-    modify_buck_rule(buck_rule, new_deps_fn=empty_deps)
-    files = subprocess.check_output(['buck',
-                                     'audit',
-                                     'input',
-                                     buck_rule],
-                                    stderr=FNULL).splitlines()
-    modify_buck_rule(buck_rule, new_deps_fn=existing_deps.union)
-    return files
-
-
-def find_cycle():
-    process = subprocess.Popen(['buck', 'targets'],
-                               stdout=FNULL,
-                               stderr=subprocess.PIPE)
-    _, stderr = process.communicate()
-    retcode = process.poll()
-    if retcode:
-        for line in stderr.splitlines():
-            if line.startswith(CYCLE_PREFIX):
-                return line[len(CYCLE_PREFIX):].split(' -> ')
+        return x.union(missing_deps)
+
+    modified_file = modify_buck_rule(rule,
+                                     new_deps_fn=update_deps,
+                                     new_rule_type=new_rule_type)
+    for dep in missing_deps.union(existing_deps):
+        if dep in android_libraries:
+            android_libraries.add(rule)
+    return modified_file
 
-    return []
 
+def add_missing_deps_pass(buck_rules, android_libraries, build_results):
+    for rule in buck_rules:
+        returncode, _, err = run_buck(['build', rule])
+        build_results[rule] = returncode == 0
+        if returncode != 0:
+            missing_deps = find_missing_deps_from_output(rule, err)
+            add_deps_to_failed_rule(rule, missing_deps, android_libraries)
 
-def find_smallest_dep(cycle):
-    small_dep = None
-    result = ()
-    for i in xrange(len(cycle)):
-        current = cycle[i]
-        next = cycle[(i + 1) % len(cycle)]
-        current_files = set(get_files_for_rule(current))
-        next_files = set(get_files_for_rule(current))
-        import pdb;
-        pdb.set_trace()
+    return flush_buck_files()
 
 
-def break_cycle():
-    cycle = find_cycle()
-    if cycle:
-        find_smallest_dep(cycle)
+def build_rules_keep_going(rules):
+    """
+    Builds all of rules with one buck invocation, returning the set of rules
+    that failed and the missing deps buck reported for each of them.
+    """
+    handle, build_report = tempfile.mkstemp(suffix='.json')
+    os.close(handle)
+    try:
+        returncode, _, err = run_buck(['build',
+                                       '--keep-going',
+                                       '--build-report',
+                                       build_report] + rules)
+        missing_deps = find_missing_deps_by_rule(err)
+        missing_deps.pop(None, None)
+        failed_rules = set(missing_deps)
+        try:
+            with open(build_report, 'r') as build_report_contents:
+                results = json.load(build_report_contents)['results']
+            failed_rules.update(rule for rule, result in results.iteritems()
+                                if not result.get('success'))
+        except (IOError, ValueError, KeyError):
+            if returncode != 0 and len(rules) == 1:
+                failed_rules.update(rules)
+    finally:
+        os.remove(build_report)
+    return failed_rules, missing_deps
+
+
+def add_missing_deps_pass_batched(buck_rules,
+                                  android_libraries,
+                                  batch_size,
+                                  jobs,
+                                  build_results):
+    batches = [buck_rules[i:i + batch_size]
+               for i in xrange(0, len(buck_rules), batch_size)]
+    pool = ThreadPool(max(jobs, 1))
+    try:
+        results = pool.map(build_rules_keep_going, batches)
+    finally:
+        pool.close()
+
+    for batch, (failed_rules, missing_deps) in zip(batches, results):
+        for rule in batch:
+            build_results[rule] = rule not in failed_rules
+        for rule in sorted(failed_rules):
+            add_deps_to_failed_rule(rule,
+                                    missing_deps.get(rule, set()),
+                                    android_libraries)
+
+    return flush_buck_files()
+
+
+def create_import_graph(buckconfig, src_roots):
+    """
+    Maps each (rule, dep) edge between first-party rules to the imports
+    that cause it, as (java file, import) pairs.
+    """
+    class_indexes = [create_source_class_index(buckconfig, src_roots)]
+    imports_by_edge = {}
+    for root, files in get_java_packages(buckconfig, src_roots):
+        java_files = [x for x in files if x.endswith('.java')]
+        rule_names = get_rule_names_for_files(root, java_files)
+        for java_file in java_files:
+            rule = '//{0}:{1}'.format(path.relpath(root),
+                                      rule_names[java_file])
+            java_file_path = path.join(root, java_file)
+            for needed_class in get_java_source(java_file_path).imports:
+                for target in resolve_import(needed_class, class_indexes):
+                    if not is_target_in_package(target, root):
+                        imports_by_edge.setdefault((rule, target), []).append(
+                            (java_file_path, needed_class))
+    return imports_by_edge
+
+
+def find_strongly_connected_components(graph, min_size=2):
+    """
+    Tarjan's algorithm, run iteratively so that long dependency chains don't
+    hit the recursion limit. By default only components with more than one
+    node, i.e. cycles, are returned. Components come after the components
+    they depend on.
+    """
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+    for start in sorted(graph):
+        if start in index:
+            continue
+        index[start] = lowlink[start] = len(index)
+        stack.append(start)
+        on_stack.add(start)
+        work = [(start, iter(sorted(graph[start])))]
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in index:
+                    index[child] = lowlink[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(sorted(graph.get(child, ())))))
+                    break
+                elif child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    if len(component) >= min_size:
+                        components.append(sorted(component))
+    return components
+
+
+def get_graph_for_edges(edges):
+    graph = {}
+    for rule, dep in edges:
+        graph.setdefault(rule, set()).add(dep)
+    return graph
+
+
+def find_cycle_cuts(edge_weights):
+    """
+    Greedily picks edges to cut until no cycles remain, always cutting the
+    edge with the fewest imports inside a remaining cycle, then puts back
+    any cut edge that turned out not to be needed.
+    """
+    edge_weights = dict(edge_weights)
+    cuts = []
+    components = find_strongly_connected_components(
+        get_graph_for_edges(edge_weights))
+    while components:
+        for component in components:
+            members = set(component)
+            lightest_edge = min((x for x in edge_weights
+                                 if x[0] in members and x[1] in members),
+                                key=lambda x: (edge_weights[x], x))
+            cuts.append((lightest_edge, edge_weights.pop(lightest_edge)))
+        components = find_strongly_connected_components(
+            get_graph_for_edges(edge_weights))
+
+    needed_cuts = []
+    for edge, weight in sorted(cuts, key=lambda x: (-x[1], x[0])):
+        edge_weights[edge] = weight
+        if find_strongly_connected_components(
+                get_graph_for_edges(edge_weights)):
+            del edge_weights[edge]
+            needed_cuts.append(edge)
+    return sorted(needed_cuts)
+
+
+def report_cycles(buckconfig, src_roots):
+    """
+    Finds every cycle between first-party rules from the imports alone and
+    prints the imports that would have to go to break each one.
+    """
+    imports_by_edge = create_import_graph(buckconfig, src_roots)
+    components = find_strongly_connected_components(
+        get_graph_for_edges(imports_by_edge))
+    for component in components:
+        members = set(component)
+        print '\tCycle between {0}'.format(', '.join(component))
+        cuts = find_cycle_cuts({
+            edge: len(imports)
+            for edge, imports in imports_by_edge.iteritems()
+            if edge[0] in members and edge[1] in members})
+        for rule, dep in cuts:
+            imports = imports_by_edge[(rule, dep)]
+            print '\t  Cut {0} -> {1} ({2} imports):'.format(rule,
+                                                            dep,
+                                                            len(imports))
+            for java_file, needed_class in sorted(imports):
+                print '\t    {0}: {1}'.format(java_file, needed_class)
+    return components
 
 
 def create_parser():
@@ -723,23 +3251,173 @@ def create_parser():
         action='store_true',
         default=False
     )
+    parser.add_argument(
+        '--split_classes',
+        dest='split_classes',
+        help='Split each package into a rule per class, or per cycle of '
+             'classes that use each other, with deps between them.',
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        '--prune_deps',
+        dest='prune_deps',
+        help='List the deps used in public or protected declarations as '
+             'exported_deps too. Deps are still kept for every import, '
+             'since javac fails on imports it can\'t resolve even when '
+             'they are unused.',
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        '--bytecode',
+        dest='bytecode',
+        help='Also work out deps from the classes in build/intermediates '
+             'and build/classes that gradle already compiled, for the files '
+             'that haven\'t changed since.',
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        '--buck',
+        dest='buck',
+        help='Buck executable to run, e.g. a fake one for testing.',
+        default=os.environ.get('BUCK', 'buck'),
+    )
+    parser.add_argument(
+        '--transitive',
+        dest='transitive',
+        help='Also add the dependencies of the maven dependencies, read from '
+             'the pom files in the gradle cache and Android SDK.',
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        '--batch',
+        dest='batch',
+        help='Whether or not to batch many targets into each buck call.',
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        '--batch_size',
+        dest='batch_size',
+        help='Number of rules built per buck call when using --batch.',
+        type=int,
+        default=50,
+    )
+    parser.add_argument(
+        '--buck_jobs',
+        dest='buck_jobs',
+        help='Number of batched buck builds to run in parallel.',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '--jobs',
+        dest='jobs',
+        help='Number of processes used to analyze java packages, and of '
+             'threads used to resolve maven dependencies.',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '--dry_run',
+        '--dry-run',
+        dest='dry_run',
+        help='Print the BUCK files that would be written as a diff, or the '
+             'planned rules as json, without writing them. Buck is still '
+             'queried, so only third party rules it already knows about '
+             'are resolved. Caches and --artifact_index are only read.',
+        nargs='?',
+        choices=['diff', 'json'],
+        const='diff',
+        default=None,
+    )
+    parser.add_argument(
+        '--incremental',
+        dest='incremental',
+        help='Only analyze the packages whose java sources changed since '
+             'the last run, and update the deps of their generated rules '
+             'in place.',
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        '--watch',
+        dest='watch',
+        help='Keep running after generating the BUCK files, updating the '
+             'deps of the generated rules whenever java files change.',
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        '--watch_interval',
+        dest='watch_interval',
+        help='Seconds between checks for changed java files with --watch.',
+        type=float,
+        default=1.0,
+    )
+    parser.add_argument(
+        '--find_cycles',
+        dest='find_cycles',
+        help='Report cycles between the generated rules and the imports '
+             'to remove to break them.',
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        '--profile',
+        dest='profile',
+        help='Write a json report of the time spent in each phase and step, '
+             'and of the subprocesses and filesystem calls made, to this '
+             'path.',
+        default=None,
+    )
+    parser.add_argument(
+        '--cprofile',
+        dest='cprofile',
+        help='Write a cProfile dump of the whole run to this path.',
+        default=None,
+    )
+    parser.add_argument(
+        '--artifact_index',
+        dest='artifact_index',
+        help='Directory of maven artifacts keyed by coordinate and sha1, '
+             'with their classes, that can be shared between checkouts and '
+             'machines. Artifacts found in it are neither hashed nor built.',
+        default=None,
+    )
+    parser.add_argument(
+        '--export_artifact_index',
+        dest='export_artifact_index',
+        help='Add the artifacts resolved and scanned by this run to '
+             '--artifact_index.',
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        '--cache_dir',
+        dest='cache_dir',
+        help='Directory used to store indexes between runs',
+        default='.gradle_to_buck',
+    )
 
     return parser
 
 
 def main():
-    print "**** Creating remote_file rules for maven deps ***"
+    configure_buck_session(args.buck, args.buck_jobs)
+    configure_cache_session(read_only=bool(args.dry_run))
+
+    begin_phase('Creating remote_file rules for maven deps')
 
     gradle_files = []
     src_roots = []
     android_directories = []
-    external_maven_repos = set()
     for root, dirs, files in os.walk(os.getcwd(), followlinks=True):
         if 'build.gradle' in files:
-            gradle_file = path.join(root, 'build.gradle')
-            gradle_files.append(gradle_file)
-            external_maven_repos = external_maven_repos.union(
-                get_repositories_from_gradle_file(gradle_file))
+            gradle_files.append(path.join(root, 'build.gradle'))
             main_root = path.join(root, 'src', 'main')
             java_root = path.join(main_root, 'java')
             if path.exists(java_root):
@@ -750,14 +3428,22 @@ def main():
     if not gradle_files:
         raise Exception("Couldn't find any 'build.gradle' files.")
 
+    gradle_build_files = parse_gradle_files(gradle_files)
+    external_maven_repos = set()
+    for gradle_build_file in gradle_build_files:
+        external_maven_repos.update(gradle_build_file.repositories)
+
+    plan = create_buck_plan()
     if not path.exists('.buckconfig'):
         maven_repos = ['mvn{0} = {1}'.format(i, repo)
                        for i, repo
                        in enumerate(external_maven_repos)]
-        with open('.buckconfig', 'w') as buck_config:
-            buck_config.write(BUCK_CONFIG_TEMPLATE.format(
-                src_roots=','.join(['/' + x for x in src_roots]),
-                maven_repositories='  \n'.join(maven_repos)))
+        plan.files['.buckconfig'] = BUCK_CONFIG_TEMPLATE.format(
+            src_roots=','.join(['/' + x for x in src_roots]),
+            maven_repositories='  \n'.join(maven_repos))
+        src_roots = ['/' + x for x in src_roots]
+    else:
+        src_roots = get_source_roots('.buckconfig')
 
     for android_directory in android_directories:
         buck_file = path.join(android_directory, 'BUCK')
@@ -767,50 +3453,123 @@ def main():
                             'AndroidManifest.xml'), 'r') as manifest_file:
             manifest_xml = xml.parse(manifest_file)
             package = manifest_xml.getroot().get('package')
-            with open(buck_file, 'w') as buck_file_handle:
-                buck_file_handle.write(ANDROID_BUILD_CONFIG_TEMPLATE.format(
+            plan.files[buck_file] = ANDROID_BUILD_CONFIG_TEMPLATE.format(
+                package=package
+            )
+            if path.exists(path.join(android_directory, 'res')):
+                plan.files[buck_file] += ANDROID_RESOURCE_TEMPLATE.format(
                     package=package
-                ))
-                if path.exists(path.join(android_directory, 'res')):
-                    buck_file_handle.write(ANDROID_RESOURCE_TEMPLATE.format(
-                        package=package
-                    ))
-
-    maven_coordinates = get_maven_coordinates(gradle_files,
-                                              args.gradle_cache)
-    write_remote_deps(args.third_party_buck, maven_coordinates)
+                )
 
-    third_party_map, android_libraries = create_third_party_map()
+    maven_coordinates = get_maven_coordinates(
+        gradle_build_files,
+        args.gradle_cache,
+        args.cache_dir,
+        jobs=args.jobs,
+        transitive=args.transitive,
+        artifact_index=args.artifact_index,
+        export_artifact_index=args.export_artifact_index)
+    write_remote_deps(args.third_party_buck, maven_coordinates, plan)
 
-    src_roots = get_source_roots('.buckconfig')
+    if not args.dry_run:
+        write_buck_plan(plan)
 
-    print "**** Generating Buck Files ***"
-    buck_rules = generate_default_buck_files(
-        '.buckconfig',
-        src_roots,
-        third_party_map,
-        android_libraries,
-        'java_library')
-
-    print "**** Adding missing dependencies ***"
-    add_missing_deps(buck_rules, android_libraries)
-
-    print "**** Checking which rules compile ***"
+    if not path.exists('.buckconfig'):
+        third_party_map, android_libraries = create_class_index({}), set()
+    elif args.batch:
+        third_party_map, android_libraries = create_third_party_map_batched(
+            args.cache_dir,
+            args.artifact_index,
+            args.export_artifact_index)
+    else:
+        third_party_map, android_libraries = create_third_party_map(
+            args.cache_dir,
+            args.artifact_index,
+            args.export_artifact_index)
+
+    third_party_android_libraries = set(android_libraries)
+
+    begin_phase('Generating Buck Files')
+    if args.bytecode:
+        PACKAGE_ANALYSIS['bytecode_index'] = create_bytecode_index(
+            '.buckconfig', src_roots)
+    state = read_cache_file(args.cache_dir, INCREMENTAL_STATE) or {}
+    if args.incremental:
+        buck_rules = update_buck_files_incrementally(
+            '.buckconfig',
+            src_roots,
+            third_party_map,
+            android_libraries,
+            'java_library',
+            state,
+            jobs=args.jobs,
+            plan=plan)
+    else:
+        buck_rules = generate_default_buck_files(
+            '.buckconfig',
+            src_roots,
+            third_party_map,
+            android_libraries,
+            'java_library',
+            jobs=args.jobs,
+            plan=plan,
+            state=state)
+
+    if args.find_cycles:
+        begin_phase('Checking for dependency cycles')
+        cycles = report_cycles('.buckconfig', src_roots)
+        print '\t*** Found {0} cycles'.format(len(cycles))
+
+    if args.dry_run:
+        print_buck_plan(plan, args.dry_run)
+        return
+    write_buck_plan(plan)
+    write_cache_file(args.cache_dir, INCREMENTAL_STATE, state)
+
+    begin_phase('Adding missing dependencies')
+    if args.batch:
+        build_results = add_missing_deps(buck_rules,
+                                         android_libraries,
+                                         batch_size=args.batch_size,
+                                         jobs=args.buck_jobs)
+    else:
+        build_results = add_missing_deps(buck_rules, android_libraries)
+
+    begin_phase('Checking which rules compile')
     passing_count = 0
 
     for buck_rule in buck_rules:
-        try:
-            subprocess.check_call(['buck', 'build', path.relpath(buck_rule)],
-                                  stdout=FNULL,
-                                  stderr=FNULL)
+        if buck_rule in build_results:
+            if build_results[buck_rule]:
+                passing_count += 1
+            continue
+        if run_buck(['build', buck_rule])[0] == 0:
             passing_count += 1
-        except:
-            pass
 
     print '{0} out of {1} rules compile!!!'.format(passing_count,
                                                    len(buck_rules))
+    print_buck_session_summary()
+
+    if args.watch:
+        begin_phase('Watching java sources')
+        watch_java_sources('.buckconfig',
+                           src_roots,
+                           third_party_map,
+                           third_party_android_libraries,
+                           'java_library',
+                           state,
+                           args.cache_dir,
+                           args.watch_interval)
+    end_phase()
 
 
 if __name__ == '__main__':
     args = create_parser().parse_args()
-    main()
+    if args.profile:
+        enable_profiling()
+    if args.cprofile:
+        cProfile.run('main()', args.cprofile)
+    else:
+        main()
+    if args.profile:
+        write_profile_report(args.profile)